@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+#D: Synthetic cycle directories and a benchmark runner for monitor_calculate_means_v7.py
+#
+#monitor_benchmark.py generate L /scratch/bench
+#  writes a synthetic UM/NEMO/CICE cycle directory at L, M or H resolution
+#monitor_benchmark.py run L /scratch/bench [--repeat 3] [--baseline bench_L.json]
+#  generates the data (if needed), runs monitor_calculate_means_v7.py on it and
+#  prints the wall time, CPU time, bytes read and peak RSS of each stage
+#
+#The files look enough like the real output for every stage to run: UM monthly
+#means with m01sXXiYYY ncvars, NEMO grid_T with thkcello and a cell area measure,
+#diaptr with zomsfatl, and CICE with aice/tarea
+
+import os
+import sys
+import json
+import argparse
+import shutil
+import subprocess
+import numpy as np
+import netCDF4
+
+#atmosphere (N96/N216/N512) and ocean/sea ice (eORCA1/025/12) grid sizes
+resolutions={'L':{'atm':(144,192),'ocean':(332,362),'levels':75},
+             'M':{'atm':(324,432),'ocean':(1207,1442),'levels':75},
+             'H':{'atm':(768,1024),'ocean':(3606,4322),'levels':75}}
+
+#same list as monitor_calculate_means_v7.py
+atm_variables=[1201,1207,1208,1209,1210,1211,1235,2201,2204,2205,2206,2207,2208,3217,3223,3225,3226,3232,3234,3236,3237,3245,3317,4204,5205,5206,5215,5216,23,24,409,8023,8208,8209,8223,8225,8234,4203,16222]
+
+#standard names used by the derived diagnostics - everything else just gets a long_name
+atm_names={1207:'toa_incoming_shortwave_flux',
+           1208:'toa_outgoing_shortwave_flux',
+           2205:'toa_outgoing_longwave_flux',
+           8223:'moisture_content_of_soil_layer',
+           16222:'air_pressure_at_sea_level'}
+
+job='bench'
+suite='u-'+job
+atm_pattern='a_1m_'
+ocn_pattern='o_1m_'
+ice_pattern='i_1m_'
+ocn_t_grid='grid-T'
+ocn_diaptr='diaptr'
+
+def stash_code(variable):
+    var_str=str(variable).rjust(5,'0')
+    return('m01s'+var_str[:-3]+'i'+var_str[-3:])
+
+def month_bounds(year,month):
+    #days since 1850-01-01 in a 360_day calendar
+    start=(year-1850)*360+(month-1)*30
+    return(start,start+30)
+
+def file_dates(year,month):
+    next_year=year+(month==12)
+    next_month=month%12+1
+    return('%04d%02d01-%04d%02d01' % (year,month,next_year,next_month))
+
+def smooth_field(lat,lon,base,amplitude,seed):
+    #a smooth, slightly noisy, field on a lat/lon grid
+    rng=np.random.default_rng(seed)
+    field=base+amplitude*np.cos(np.deg2rad(lat))+0.1*amplitude*np.sin(np.deg2rad(2*lon))
+    return(field+0.01*amplitude*rng.standard_normal(field.shape))
+
+def add_time(nc,name,year,month,long_name):
+    nc.createDimension(name,None)
+    time=nc.createVariable(name,'f8',(name,))
+    time.standard_name='time'
+    time.long_name=long_name
+    time.axis='T'
+    time.units='days since 1850-01-01'
+    time.calendar='360_day'
+    time.bounds=name+'_bnds'
+    nc.createDimension('bnds',2)
+    time_bnds=nc.createVariable(name+'_bnds','f8',(name,'bnds'))
+    start,end=month_bounds(year,month)
+    time[0]=0.5*(start+end)
+    time_bnds[0,:]=[start,end]
+
+def write_atm(path,ny,nx,year,month):
+    with netCDF4.Dataset(path,'w') as nc:
+        add_time(nc,'time',year,month,'time')
+        nc.createDimension('latitude',ny)
+        nc.createDimension('longitude',nx)
+        nc.createDimension('depth',4)
+        lat=nc.createVariable('latitude','f8',('latitude',))
+        lat.standard_name='latitude'
+        lat.units='degrees_north'
+        lat.axis='Y'
+        lat[:]=-90+180*(np.arange(ny)+0.5)/ny
+        lon=nc.createVariable('longitude','f8',('longitude',))
+        lon.standard_name='longitude'
+        lon.units='degrees_east'
+        lon.axis='X'
+        lon[:]=360*(np.arange(nx)+0.5)/nx
+        depth=nc.createVariable('depth','f8',('depth',))
+        depth.standard_name='depth'
+        depth.units='m'
+        depth.axis='Z'
+        depth.positive='down'
+        depth[:]=[0.05,0.225,0.675,2.0]
+
+        lat2,lon2=np.meshgrid(lat[:],lon[:],indexing='ij')
+        #crude land mask for the land only fields
+        land=np.sin(np.deg2rad(3*lon2))*np.cos(np.deg2rad(lat2))>0.3
+        for n,variable in enumerate(atm_variables):
+            code=stash_code(variable)
+            if variable==8223:
+                var=nc.createVariable(code,'f4',('time','depth','latitude','longitude'),fill_value=-1.0e30)
+                data=np.ma.masked_array(np.broadcast_to(smooth_field(lat2,lon2,100,50,n),(4,ny,nx)),
+                                        mask=np.broadcast_to(~land,(4,ny,nx)))
+                var[0]=data
+            else:
+                var=nc.createVariable(code,'f4',('time','latitude','longitude'),fill_value=-1.0e30)
+                var[0]=smooth_field(lat2,lon2,250,50,n)
+            if variable in atm_names:
+                var.standard_name=atm_names[variable]
+            var.long_name='stash code '+code
+            var.units='1'
+            var.online_operation='average'
+            var.interval_write='1 month'
+
+def ocean_grid(ny,nx):
+    #a regular stand-in for the eORCA grid (rows of constant latitude)
+    lat=np.linspace(-78.0,89.5,ny)
+    lon=np.linspace(-180.0,180.0,nx,endpoint=False)+180.0/nx
+    return(np.meshgrid(lat,lon,indexing='ij'))
+
+def add_ocean_coords(nc,ny,nx,lat2,lon2):
+    nc.createDimension('y',ny)
+    nc.createDimension('x',nx)
+    nav_lat=nc.createVariable('nav_lat','f4',('y','x'))
+    nav_lat.standard_name='latitude'
+    nav_lat.units='degrees_north'
+    nav_lat[:]=lat2
+    nav_lon=nc.createVariable('nav_lon','f4',('y','x'))
+    nav_lon.standard_name='longitude'
+    nav_lon.units='degrees_east'
+    nav_lon[:]=lon2
+
+def write_grid_t(path,ny,nx,nz,year,month):
+    lat2,lon2=ocean_grid(ny,nx)
+    with netCDF4.Dataset(path,'w') as nc:
+        add_time(nc,'time_counter',year,month,'Time axis')
+        add_ocean_coords(nc,ny,nx,lat2,lon2)
+        nc.createDimension('deptht',nz)
+        deptht=nc.createVariable('deptht','f4',('deptht',))
+        deptht.standard_name='depth'
+        deptht.units='m'
+        deptht.axis='Z'
+        deptht.positive='down'
+        thickness=np.geomspace(1.0,200.0,nz)
+        deptht[:]=np.cumsum(thickness)-0.5*thickness
+
+        area=nc.createVariable('area','f4',('y','x'))
+        area.standard_name='cell_area'
+        area.units='m2'
+        area[:]=(111e3*360.0/nx)*(111e3*167.5/ny)*np.cos(np.deg2rad(lat2))
+
+        #bathymetry - shallower towards the poles
+        bottom=(nz*np.cos(np.deg2rad(lat2))**0.5).astype(int)
+        variables=[('thetao','sea_water_potential_temperature','degC',15.0,10.0),
+                   ('so','sea_water_salinity','0.001',35.0,1.0),
+                   ('thkcello','cell_thickness','m',None,None)]
+        for ncvar,standard_name,units,base,amplitude in variables:
+            var=nc.createVariable(ncvar,'f4',('time_counter','deptht','y','x'),fill_value=1.0e20)
+            var.standard_name=standard_name
+            var.units=units
+            var.coordinates='nav_lat nav_lon'
+            var.cell_measures='area: area'
+            #one level at a time, so the H grid can be written in bounded memory
+            for level in range(nz):
+                if base is None:
+                    data=np.full((ny,nx),thickness[level],dtype=np.float32)
+                else:
+                    data=smooth_field(lat2,lon2,base-level*amplitude/nz,amplitude,level).astype(np.float32)
+                var[0,level]=np.ma.masked_array(data,mask=bottom<=level)
+
+def write_diaptr(path,ny,nz,year,month):
+    lat2,lon2=ocean_grid(ny,1)
+    with netCDF4.Dataset(path,'w') as nc:
+        add_time(nc,'time_counter',year,month,'Time axis')
+        add_ocean_coords(nc,ny,1,lat2,lon2)
+        nc.createDimension('depthw',nz)
+        depthw=nc.createVariable('depthw','f4',('depthw',))
+        depthw.standard_name='depth'
+        depthw.units='m'
+        depthw.axis='Z'
+        depthw.positive='down'
+        depthw[:]=np.linspace(0.0,6000.0,nz)
+        var=nc.createVariable('zomsfatl','f4',('time_counter','depthw','y','x'),fill_value=1.0e20)
+        var.long_name='Meridional Stream-Function: Atlantic'
+        var.units='Sv'
+        var.coordinates='nav_lat nav_lon'
+        depth_profile=np.sin(np.pi*np.arange(nz)/nz)[:,None]
+        data=17.0*depth_profile*np.cos(np.deg2rad(lat2[:,0]-30.0))[None,:]
+        #no Atlantic south of 30S
+        var[0,:,:,0]=np.ma.masked_array(data,mask=np.broadcast_to(lat2[:,0]<-30.0,data.shape))
+
+def write_cice(path,ny,nx,year,month):
+    lat2,lon2=ocean_grid(ny,nx)
+    with netCDF4.Dataset(path,'w') as nc:
+        add_time(nc,'time',year,month,'model time')
+        nc.createDimension('nj',ny)
+        nc.createDimension('ni',nx)
+        tlat=nc.createVariable('TLAT','f4',('nj','ni'))
+        tlat.long_name='T grid center latitude'
+        tlat.units='degrees_north'
+        tlat[:]=lat2
+        tlon=nc.createVariable('TLON','f4',('nj','ni'))
+        tlon.long_name='T grid center longitude'
+        tlon.units='degrees_east'
+        tlon[:]=lon2
+        tarea=nc.createVariable('tarea','f4',('nj','ni'))
+        tarea.long_name='area of T grid cells'
+        tarea.units='m^2'
+        tarea.coordinates='TLON TLAT'
+        area=(111e3*360.0/nx)*(111e3*167.5/ny)*np.cos(np.deg2rad(lat2))
+        #land has zero area in CICE
+        area[::7,::5]=0.0
+        tarea[:]=area
+        aice=nc.createVariable('aice','f4',('time','nj','ni'),fill_value=1.0e30)
+        aice.long_name='ice area  (aggregate)'
+        aice.units='1'
+        aice.coordinates='TLON TLAT'
+        aice.cell_measures='area: tarea'
+        aice[0]=np.clip((np.abs(lat2)-60.0)/20.0,0.0,1.0)
+
+def generate(resolution,workdir,date):
+    #write one synthetic cycle directory - returns the data directory
+    grids=resolutions[resolution]
+    year=int(date[0:4])
+    month=int(date[4:6])
+    data_dir=os.path.join(workdir,'transfer',suite,date)
+    done_file=os.path.join(data_dir,'.generated_'+resolution)
+    if os.path.exists(done_file):
+        return(data_dir)
+    os.makedirs(data_dir,exist_ok=True)
+    dates=file_dates(year,month)
+    ny,nx=grids['atm']
+    print("Writing "+resolution+" atmosphere")
+    write_atm(os.path.join(data_dir,job+atm_pattern+dates+'.nc'),ny,nx,year,month)
+    ny,nx=grids['ocean']
+    print("Writing "+resolution+" ocean")
+    write_grid_t(os.path.join(data_dir,job+ocn_pattern+dates+'_'+ocn_t_grid+'.nc'),ny,nx,grids['levels'],year,month)
+    write_diaptr(os.path.join(data_dir,job+ocn_pattern+dates+'_'+ocn_diaptr+'.nc'),ny,grids['levels']+1,year,month)
+    print("Writing "+resolution+" sea ice")
+    write_cice(os.path.join(data_dir,job+ice_pattern+dates+'.nc'),ny,nx,year,month)
+    open(done_file,'w').close()
+    return(data_dir)
+
+def run_once(workdir,date,cache_dir,extra_args):
+    #run monitor_calculate_means_v7.py on the synthetic cycle and return its timing report
+    run_dir=os.path.join(workdir,'run')
+    os.makedirs(run_dir,exist_ok=True)
+    here=os.path.dirname(os.path.abspath(__file__))
+    #the script execs cf_patches.py from its working directory
+    patch_link=os.path.join(run_dir,'cf_patches.py')
+    if not os.path.exists(patch_link):
+        os.symlink(os.path.join(here,'cf_patches.py'),patch_link)
+
+    env=dict(os.environ)
+    env.update({'CYLC_VERSION':'8.0.0',
+                'CYLC_WORKFLOW_NAME':suite,
+                'CYLC_TASK_CYCLE_POINT':date,
+                'TRANSFER_DIR':os.path.join(workdir,'transfer'),
+                'ATM_PATTERNS':atm_pattern,
+                'ICE_PATTERNS':ice_pattern,
+                'OCN_PATTERNS':ocn_pattern,
+                'OCN_T_GRID':ocn_t_grid,
+                'OCN_DIAPTR':ocn_diaptr,
+                'MONITOR_INCREMENTAL':'0',
+                'MONITOR_TIMING':'1',
+                #a failed run must not make the next one resume from checkpoints
+                'MONITOR_CHECKPOINT_DIR':'',
+                'MONITOR_CACHE_DIR':cache_dir})
+    command=[sys.executable,os.path.join(here,'monitor_calculate_means_v7.py')]+extra_args
+    result=subprocess.run(command,cwd=run_dir,env=env,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,text=True)
+    if result.returncode!=0:
+        print(result.stdout)
+        print("monitor_calculate_means_v7.py failed!")
+        exit(99)
+    with open(os.path.join(run_dir,'monitor_index','index_'+job+'_'+date+'.timing.json')) as f:
+        return(json.load(f))
+
+def summarise(reports):
+    #best (minimum) of each stage over the repeats - the least noisy estimate
+    summary={}
+    for report in reports:
+        for stage in report['stages']:
+            name=stage['stage']
+            if not name in summary:
+                summary[name]=dict(stage)
+                continue
+            for key in ('wall_s','cpu_s','bytes_read'):
+                summary[name][key]=min(summary[name][key],stage[key])
+            summary[name]['peak_rss_mb']=max(summary[name]['peak_rss_mb'],stage['peak_rss_mb'])
+    for stage in summary.values():
+        del stage['pid']
+    return(summary)
+
+def print_summary(title,summary,baseline=None,threshold=0.2):
+    print(title)
+    print('%-40s %9s %9s %12s %10s' % ('stage','wall s','cpu s','MB read','peak MB'))
+    regressions=[]
+    for name,stage in summary.items():
+        flag=''
+        if baseline is not None and name in baseline:
+            before=baseline[name]['wall_s']
+            if before>0.05 and stage['wall_s']>before*(1+threshold):
+                flag=' <- was %.2f' % before
+                regressions.append(name)
+        print('%-40s %9.2f %9.2f %12.1f %10.1f%s' % (name[:40],stage['wall_s'],stage['cpu_s'],
+                                                     stage['bytes_read']/1e6,stage['peak_rss_mb'],flag))
+    return(regressions)
+
+def main():
+    parser=argparse.ArgumentParser(description='Synthetic-data benchmark for monitor_calculate_means_v7.py')
+    parser.add_argument('action',choices=['generate','run'])
+    parser.add_argument('resolution',choices=sorted(resolutions))
+    parser.add_argument('workdir')
+    parser.add_argument('--date',default='19500101T0000Z',help='cycle point to generate/run')
+    parser.add_argument('--levels',type=int,help='number of ocean levels (default 75)')
+    parser.add_argument('--repeat',type=int,default=3,help='warm runs to time')
+    parser.add_argument('--baseline',help='summary json from an earlier run to compare against')
+    parser.add_argument('--threshold',type=float,default=0.2,help='fractional slow down counted as a regression')
+    parser.add_argument('--parallel-realms',action='store_true',help='pass --parallel-realms to the script')
+    args=parser.parse_args()
+
+    if args.levels is not None:
+        resolutions[args.resolution]['levels']=args.levels
+    workdir=os.path.abspath(os.path.join(args.workdir,args.resolution))
+
+    generate(args.resolution,workdir,args.date)
+    if args.action=='generate':
+        return
+
+    extra_args=[]
+    if args.parallel_realms:
+        extra_args.append('--parallel-realms')
+
+    #first run with an empty cache, then the warm runs with the cache it filled
+    cache_dir=os.path.join(workdir,'cache')
+    shutil.rmtree(cache_dir,ignore_errors=True)
+    cold=summarise([run_once(workdir,args.date,cache_dir,extra_args)])
+    warm=summarise([run_once(workdir,args.date,cache_dir,extra_args) for n in range(args.repeat)])
+
+    baseline=None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline=json.load(f)['warm']
+    print_summary('Cold cache ('+args.resolution+')',cold)
+    regressions=print_summary('Warm cache ('+args.resolution+', best of '+str(args.repeat)+')',warm,baseline,args.threshold)
+
+    summary_file=os.path.join(workdir,'bench_'+args.resolution+'.json')
+    with open(summary_file,'w') as f:
+        json.dump({'resolution':args.resolution,'cold':cold,'warm':warm},f,indent=1)
+    print("Written "+summary_file)
+
+    if len(regressions)>0:
+        print("Slower than the baseline: "+', '.join(regressions))
+        exit(1)
+
+if __name__=='__main__':
+    main()
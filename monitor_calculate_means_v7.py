@@ -17,19 +17,146 @@
 import cf
 import re
 import glob
+import fnmatch
 import sys
 import numpy as np
+import scipy.sparse
 import os
 import smtplib, ssl
 from email.message import EmailMessage
 import traceback
 import urllib3
+import netCDF4
 import json
+import hashlib
+import argparse
+import multiprocessing
+import concurrent.futures
+import contextlib
+import resource
+import time
+import fcntl
+import configparser
+import threading
+import atexit
+import monitor_io
 
 #this patches the broken weights_measure function
 patch_file='cf_patches.py'
 exec(compile(source=open(patch_file).read(), filename=patch_file, mode='exec'))
 
+#directory for grid level quantities (weights etc.) that are reused between
+#cycles - set MONITOR_CACHE_DIR to an empty string to switch this off
+cache_dir=os.getenv('MONITOR_CACHE_DIR','monitor_cache')
+
+#each realm's indices are written here as soon as they are computed, so a rerun
+#after a failure only computes the missing realms - set MONITOR_CHECKPOINT_DIR
+#to an empty string to switch this off
+checkpoint_dir=os.getenv('MONITOR_CHECKPOINT_DIR',os.path.join(os.getenv('SCRATCH','/tmp'),'monitor_checkpoints'))
+
+#area weights for each grid seen so far in this run, keyed by grid signature
+weights_cache={}
+
+#latitude of the AMOC index
+amoc_latitude=float(os.getenv('AMOC_LATITUDE','45'))
+
+#Closest jline to 45N, worked out by hand for the standard resolutions
+#see /home/users/dlrhodso/CANARI/monitoring/get_amoc_45_jline.sh
+#Closest jline to 45N is j=2647 for H
+#Closest jline to 45N is j=886 for M
+#Closest jline to 45N is j=251 for L
+amoc_45_mappings={'332':'251',
+                  '1207':'886',
+                  '3606':'2647'
+              }
+
+#jlines for each (grid size, latitude) - read from cache_dir when first needed
+amoc_jlines=None
+
+#extra latitude bands for the sea ice area, as name:south:north[,name:south:north...]
+#e.g. SEAICE_BANDS=arctic:66.5:90,antarctic:-90:-66.5
+seaice_bands=[]
+for band in os.getenv('SEAICE_BANDS','').split(','):
+    if band.strip()!='':
+        band_name,band_south,band_north=band.split(':')
+        seaice_bands.append((band_name.strip(),float(band_south),float(band_north)))
+
+#memory budget in MB for the ocean volume means - when set, the volume weighted
+#sums are accumulated a few depth levels at a time rather than in memory
+memory_budget=os.getenv('MONITOR_MEMORY_BUDGET_MB','')
+if memory_budget=='':
+    memory_budget=None
+else:
+    memory_budget=float(memory_budget)*1024*1024
+
+#write the wall time, CPU time, bytes read and peak RSS of each stage to a json
+#file next to the index file - set MONITOR_TIMING=0 to switch this off
+timing=os.getenv('MONITOR_TIMING','1')!='0'
+stage_timings=[]
+#running peak RSS (MB) of this process and of each stage still open - the kernel
+#high water mark is reset at the start of every stage
+open_stages=[[0.0]]
+
+#also append every cycle's indices to one per-job file (monitor_index/timeseries_<job>.nc)
+#so readers open one file rather than hundreds - MONITOR_STORE=0 to switch off
+timeseries_store=os.getenv('MONITOR_STORE','1')!='0'
+
+#static grid quantities (ocean cell area, CICE tarea and latitudes) used so far in
+#this run, keyed by realm, name and grid signature
+static_cache={}
+
+#atmosphere streams searched, in order, for a STASH code with no monthly mean
+#the daily/hourly data is reduced to monthly means file by file
+fallback_streams=[stream.strip() for stream in os.getenv('ATM_FALLBACK_STREAMS','day,1hr').split(',') if stream.strip()!='']
+#working memory (bytes) for that reduction when MONITOR_MEMORY_BUDGET_MB is not set
+fallback_budget=512*1024*1024
+
+#reduce all the (time,Y,X) atmosphere variables on a grid together - set
+#MONITOR_BATCH_MEANS=0 to collapse each variable separately
+batch_means=os.getenv('MONITOR_BATCH_MEANS','1')!='0'
+#working memory (bytes) for one batch when MONITOR_MEMORY_BUDGET_MB is not set -
+#a grid's variables are split into as many batches as they need
+batch_budget=1024*1024*1024
+
+#extra statistics of each area mean, volume mean and sea ice area, as a comma
+#separated list of min, max, std and pNN (weighted NN-th percentile) - each is
+#written as its own series, named with a _<statistic> suffix
+#e.g. MONITOR_STATISTICS=min,max,std,p5,p95
+statistics=[statistic.strip() for statistic in os.getenv('MONITOR_STATISTICS','').split(',') if statistic.strip()!='']
+for statistic in statistics:
+    if not (statistic in ('min','max','std') or re.match(r'^p\d+(\.\d+)?$',statistic)):
+        raise ValueError("Unknown statistic "+statistic+" in MONITOR_STATISTICS - use min, max, std or pNN")
+    if statistic.startswith('p') and float(statistic[1:])>100:
+        raise ValueError("Percentile "+statistic+" in MONITOR_STATISTICS is over 100")
+
+#the variables and regional indices to compute are read from this file
+#anything it doesn't define comes from the built-in lists below
+index_registry_file=os.getenv('MONITOR_INDICES','monitor_indices.conf')
+
+#no MSLP in 1m? 16222
+default_atm_variables=[1201,1207,1208,1209,1210,1211,1235,2201,2204,2205,2206,2207,2208,3217,3223,3225,3226,3232,3234,3236,3237,3245,3317,4204,5205,5206,5215,5216,23,24,409,8023,8208,8209,8223,8225,8234,4203,16222]
+default_ocean_variables=['sea_water_potential_temperature','sea_water_salinity']
+
+#named regions, each compiled once per grid into a sparse (points,regions) weight
+#matrix - more can be defined as [region:NAME] sections of the registry
+#types: global, hemisphere (side), band (south, north), box (west:east:south:north),
+#basin (mask_file, mask_variable, value) and land/sea (mask_file, mask_variable, threshold)
+default_regions={'global':{'type':'global'},
+                 'northern_hemisphere':{'type':'hemisphere','side':'north'},
+                 'southern_hemisphere':{'type':'hemisphere','side':'south'},
+                 'nao_azores':{'type':'box','box':[-90.0,60.0,20.0,55.0]},
+                 'nao_iceland':{'type':'box','box':[-90.0,60.0,55.0,90.0]}}
+region_library=dict(default_regions)
+
+#region weight matrices compiled so far, keyed by grid signature and region names
+region_matrices={}
+
+#regional indices: the index is the region value minus the minus_region value
+#(if given), averaged over the season months of each year
+default_indices=[{'name':'NAO_jfm_box','realm':'atm','source':16222,
+                  'region':'nao_azores','minus_region':'nao_iceland',
+                  'reduction':'mean','season':[1,2,3]}]
+
 
 def fix_time_axis(fieldlist):
     #Check to see if we are using an auxiliary time axis
@@ -65,15 +192,111 @@ def fix_time_axis(fieldlist):
             field.set_construct(new_T_axis)
     return()
 
-def get_NAO(jfm):
-    q_jfm=cf.Query("ge", 1)&cf.Query("le", 3)
-    q_jfm=q_jfm.addattr("month")
-    iceland_box=jfm.subspace(X=cf.wi(-90,60),Y=cf.wi(55,90))
-    azores_box=jfm.subspace(X=cf.wi(-90,60),Y=cf.wi(20,55))
-    nao_jfm=azores_box.collapse('area: mean',weights=True,squeeze=True)-iceland_box.collapse('area: mean', weights=True,squeeze=True)
-    nao_jfm.standard_name='NAO_jfm_box'
-    nao_jfm_mean=nao_jfm.collapse('time: mean',group=q_jfm)
-    return(nao_jfm_mean)
+def parse_box(box):
+    #a list rather than a tuple, so it compares equal to the copy in the manifest
+    box=[float(edge) for edge in box.split(':')]
+    if len(box)!=4:
+        raise ValueError("A box is west:east:south:north, not "+':'.join(str(edge) for edge in box))
+    return(box)
+
+def parse_region(name,entry):
+    #a region from a [region:NAME] section
+    kind=entry.get('type')
+    region={'type':kind}
+    if kind=='hemisphere':
+        region['side']=entry.get('side')
+        if not region['side'] in ('north','south'):
+            raise ValueError("Region "+name+": side must be north or south")
+    elif kind=='band':
+        region['south']=float(entry.get('south'))
+        region['north']=float(entry.get('north'))
+    elif kind=='box':
+        region['box']=parse_box(entry.get('box'))
+    elif kind in ('basin','land','sea'):
+        region['mask_file']=entry.get('mask_file')
+        region['mask_variable']=entry.get('mask_variable')
+        if region['mask_file'] is None or region['mask_variable'] is None:
+            raise ValueError("Region "+name+" needs a mask_file and mask_variable")
+        if kind=='basin':
+            region['value']=float(entry.get('value'))
+        else:
+            region['threshold']=float(entry.get('threshold','0.5'))
+    elif kind!='global':
+        raise ValueError("Region "+name+": unknown type "+str(kind))
+    return(region)
+
+def index_region(index,entry,key,library):
+    #the region of an index - a named region, or a box given directly
+    if entry.get(key,'').strip()!='':
+        name=entry.get(key).strip()
+        if not name in library:
+            raise ValueError("Index "+index['name']+": unknown region "+name)
+        return(name)
+    box_key=key.replace('region','box')
+    if entry.get(box_key,'').strip()!='':
+        box=parse_box(entry.get(box_key))
+        name=':'.join(format(edge,'g') for edge in box)
+        library[name]={'type':'box','box':box}
+        return(name)
+    return(None)
+
+def read_index_registry(registry_file):
+    #the atmosphere and ocean variables, the regions and the regional indices to compute
+    #each [region:NAME] section defines a region; each [index:NAME] section gives the
+    #realm, source, region (or box), minus_region (or minus_box), reduction and season
+    #[variables] regions and seaice_regions are the regions every atmosphere variable
+    #and the sea ice area are also reduced over
+    variables={'atm':default_atm_variables,'ocean':default_ocean_variables,
+               'regions':[],'seaice_regions':[]}
+    indices=default_indices
+    library=dict(default_regions)
+    if not os.path.exists(registry_file):
+        print("No "+registry_file+" - using the built-in variables and indices")
+        return(variables,indices,library)
+
+    config=configparser.ConfigParser(inline_comment_prefixes=(';',))
+    config.read(registry_file)
+    if config.has_option('variables','atm'):
+        variables['atm']=[int(variable) for variable in config.get('variables','atm').split(',') if variable.strip()!='']
+    if config.has_option('variables','ocean'):
+        variables['ocean']=[variable.strip() for variable in config.get('variables','ocean').split(',') if variable.strip()!='']
+
+    for section in config.sections():
+        if section.startswith('region:'):
+            name=section[len('region:'):].strip()
+            library[name]=parse_region(name,config[section])
+    for option in ('regions','seaice_regions'):
+        if config.has_option('variables',option):
+            variables[option]=[name.strip() for name in config.get('variables',option).split(',') if name.strip()!='']
+            for name in variables[option]:
+                if not name in library:
+                    raise ValueError("Unknown region "+name+" in [variables] "+option)
+
+    sections=[section for section in config.sections() if section.startswith('index:')]
+    if len(sections)>0:
+        indices=[]
+        for section in sections:
+            entry=config[section]
+            index={'name':section[len('index:'):].strip(),
+                   'realm':entry.get('realm','atm'),
+                   'source':entry.get('source'),
+                   'reduction':entry.get('reduction','mean'),
+                   'season':None}
+            if index['realm']!='atm':
+                raise ValueError("Index "+index['name']+": only atm indices are supported, not "+index['realm'])
+            if index['source'] is None:
+                raise ValueError("Index "+index['name']+" has no source")
+            index['source']=int(index['source'])
+            index['region']=index_region(index,entry,'region',library)
+            if index['region'] is None:
+                index['region']='global'
+            index['minus_region']=index_region(index,entry,'minus_region',library)
+            if not index['reduction'] in ('mean','sum'):
+                raise ValueError("Index "+index['name']+": reduction must be mean or sum, not "+index['reduction'])
+            if entry.get('season','').strip()!='':
+                index['season']=[int(month) for month in entry.get('season').split(',')]
+            indices.append(index)
+    return(variables,indices,library)
 
 def get_error():
     exception_type, exception_value, trace = sys.exc_info()
@@ -85,98 +308,372 @@ def get_error():
     subject="Error report for {} {}\n".format(job,date)
     return(subject+error_string)
 
-# Send Slack notification based on the given message
-def slack_notification(message):
-    # Try to read webhook URL from config file
+def read_webhook_url():
+    # Try to read webhook URL from config file - once, when the script starts,
+    # rather than in the error path. MONITOR_WEBHOOK_URL overrides it (e.g. to
+    # point at monitor_webhook_standin.py)
+    webhook_url=os.getenv('MONITOR_WEBHOOK_URL')
+    if webhook_url is None:
+        try:
+            config = configparser.ConfigParser()
+            config.read('monitor.conf')
+            webhook_url = config.get('slack', 'webhook_url', fallback='')
+        except configparser.Error:
+            webhook_url = ''
+    #monitor.conf has webhook_url='' for "not set"
+    return(webhook_url.strip().strip("'\""))
+
+webhook_url=read_webhook_url()
+
+#an error notification is sent by a background thread; the script waits at most
+#this many seconds (in total) for them to finish when it exits
+notify_deadline=float(os.getenv('MONITOR_NOTIFY_TIMEOUT','5'))
+#the same (job, error type) is only sent once in this many hours - repeats are counted
+notify_repeat_hours=float(os.getenv('MONITOR_NOTIFY_REPEAT_HOURS','24'))
+#what has been sent, and notifications that couldn't be sent
+notify_state_file=os.getenv('MONITOR_NOTIFY_STATE','.monitor_notifications.json')
+notify_spool_file=os.getenv('MONITOR_NOTIFY_SPOOL','monitor_notifications.spool')
+
+#notifications started by this process, each {'message':..,'done':threading.Event()}
+notifications=[]
+
+def spool_notification(message,reason):
+    #keep a notification that couldn't be delivered
     try:
-        import configparser
-        config = configparser.ConfigParser()
-        config.read('monitor.conf')
-        webhook_url = config.get('slack', 'webhook_url', fallback='')
-    except (FileNotFoundError, configparser.Error):
-        webhook_url = ''
-    
-    # Return early if webhook URL is empty or not defined
-    if not webhook_url:
-        return
-    
+        with open(notify_spool_file,'a') as f:
+            f.write(json.dumps({'time':time.strftime('%Y-%m-%dT%H:%M:%S'),'reason':reason,'message':message})+'\n')
+    except OSError:
+        traceback.print_exc()
+
+def post_notification(notification):
+    # Send Slack notification based on the given message
     try:
-        slack_message = {'text': message}
+        slack_message = {'text': notification['message']}
 
         http = urllib3.PoolManager()
         response = http.request('POST',
                                 webhook_url,
                                 body = json.dumps(slack_message),
                                 headers = {'Content-Type': 'application/json'},
+                                timeout = urllib3.Timeout(total=notify_deadline),
                                 retries = False)
-    except:
+        if response.status>=300:
+            spool_notification(notification['message'],'HTTP status '+str(response.status))
+        else:
+            #only a delivered notification holds back the repeats
+            mark_notified(notification['key'])
+    except Exception as error:
+        spool_notification(notification['message'],type(error).__name__+': '+str(error))
+    notification['done'].set()
+
+def update_notify_state(update):
+    #apply update(state) to the notification state and return its result (None if
+    #the state can't be kept here) - the state file is shared by every job run
+    #from this directory, so lock it
+    try:
+        with open(notify_state_file+'.lock','w') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            try:
+                with open(notify_state_file) as f:
+                    state=json.load(f)
+            except (OSError,ValueError):
+                state={}
+            result=update(state)
+            with open(notify_state_file+'.tmp','w') as f:
+                json.dump(state,f)
+            os.replace(notify_state_file+'.tmp',notify_state_file)
+            return(result)
+    except OSError:
         traceback.print_exc()
-
-    return True
+        return(None)
+
+def should_notify(key):
+    #whether key (job and error type) should be sent - not if it was delivered in
+    #the last notify_repeat_hours - and how many repeats were held back since then
+    def check(state):
+        sent,suppressed=state.get(key,[0.0,0])
+        if time.time()-sent<notify_repeat_hours*3600:
+            state[key]=[sent,suppressed+1]
+            return((False,suppressed))
+        return((True,suppressed))
+    result=update_notify_state(check)
+    if result is None:
+        #can't keep state here - send everything
+        return(True,0)
+    return(result)
+
+def mark_notified(key):
+    def mark(state):
+        state[key]=[time.time(),0]
+    update_notify_state(mark)
+
+def slack_notification(message,key):
+    # Return early if webhook URL is empty or not defined
+    if not webhook_url:
+        return
+    if any(notification['key']==key and not notification['done'].is_set() for notification in notifications):
+        print("Already sending "+key+" - not sending again")
+        return
+    send,suppressed=should_notify(key)
+    if not send:
+        print("Already notified "+key+" in the last "+format(notify_repeat_hours,'g')+" hours - not sending")
+        return
+    if suppressed>0:
+        message+="\n\n("+str(suppressed)+" more of these since the last notification)"
+    notification={'message':message,'key':key,'done':threading.Event()}
+    notifications.append(notification)
+    #daemon, so a hung connection can never keep the process alive
+    threading.Thread(target=post_notification,args=(notification,),daemon=True).start()
+
+@atexit.register
+def wait_for_notifications():
+    #give the notifications at most notify_deadline seconds between them, then
+    #spool any still going and let the process exit
+    end=time.time()+notify_deadline
+    for notification in notifications:
+        if not notification['done'].wait(max(0.0,end-time.time())):
+            spool_notification(notification['message'],'not sent within '+format(notify_deadline,'g')+'s')
+
+def error_place():
+    #where in this script the current error came from (function:line) - nearly
+    #every failure leaves through exit(99), so the exception type alone doesn't
+    #tell one failure from another
+    frames=traceback.extract_tb(sys.exc_info()[2])
+    own=[frame for frame in frames if os.path.abspath(frame.filename)==os.path.abspath(__file__)]
+    if len(own)>0:
+        frames=own
+    if len(frames)==0:
+        return('')
+    return(frames[-1].name+':'+str(frames[-1].lineno))
 
 def report_error():
     message=get_error()
     print(message)
-    slack_notification(message)
+    exception_type,exception_value=sys.exc_info()[:2]
+    #a failure of realms run in parallel carries the places in the workers
+    places=getattr(exception_value,'places',[error_place()])
+    slack_notification(message,' '.join([job,exception_type.__name__]+places))
 
 
-def read_cice(patterns):
-    #read in cice files
+def bytes_read():
+    #bytes read by this process so far (includes reads served from the page cache)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return(int(line.split()[1]))
+    except OSError:
+        pass
+    return(0)
+
+def high_water_mb():
+    #peak RSS of this process since the high water mark was last reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1])/1024.0)
+    except OSError:
+        pass
+    #ru_maxrss is in kB on Linux
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0)
+
+def reset_high_water():
+    #set the high water mark back to the current RSS (Linux 4.0 on) - without
+    #this each stage would report the peak of every stage before it
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def fold_high_water(peak):
+    #count a peak in every stage still open (and in the process as a whole)
+    for running in open_stages:
+        running[0]=max(running[0],peak)
+
+@contextlib.contextmanager
+def stage(name):
+    #record the cost of the code in this block as one stage of the report
+    if not timing:
+        yield
+        return
+    wall=time.perf_counter()
+    cpu=time.process_time()
+    read=bytes_read()
+    #the peak so far belongs to the stages this one is nested in
+    fold_high_water(high_water_mb())
+    reset_high_water()
+    peak=[0.0]
+    open_stages.append(peak)
+    try:
+        yield
+    finally:
+        open_stages.pop()
+        peak[0]=max(peak[0],high_water_mb())
+        fold_high_water(peak[0])
+        stage_timings.append({'stage':name,
+                              'wall_s':round(time.perf_counter()-wall,3),
+                              'cpu_s':round(time.process_time()-cpu,3),
+                              'bytes_read':bytes_read()-read,
+                              'peak_rss_mb':round(peak[0],1),
+                              'pid':os.getpid()})
+
+def write_timings(timing_file):
+    #ru_maxrss is reset with the high water mark too, so the total is the largest
+    #of the process peak and the stage peaks (which include the worker processes)
+    fold_high_water(high_water_mb())
+    peaks=[open_stages[0][0],resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0]
+    peaks+=[stage_timing['peak_rss_mb'] for stage_timing in stage_timings]
+    report={'job':job,'date':date,'stages':stage_timings,
+            'total_peak_rss_mb':round(max(peaks),1)}
+    with open(timing_file,'w') as f:
+        json.dump(report,f,indent=1)
+
+def persist(fields):
+    #compute any lazy data now - so the time is counted in this stage rather than
+    #in cf.write (and, in a worker process, is done by the worker)
+    for field in fields:
+        if hasattr(field,'persist'):
+            field.persist(inplace=True)
+    return(fields)
+
+def build_inventory(directory):
+    #scan the cycle directory ONCE and record the size and mtime of every file
+    #all the readers select their files from this inventory rather than
+    #globbing data_dir again for every pattern and grid
+    inventory={'dir':directory,'files':{},'index':{},'streams':{}}
+    if not os.path.isdir(directory):
+        print("Data directory "+directory+" does not exist!")
+        return(inventory)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            #glob('*') skips hidden files - so do we
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat=entry.stat()
+            inventory['files'][entry.name]={'path':entry.path,
+                                            'size':stat.st_size,
+                                            'mtime':stat.st_mtime}
+    print("Found "+str(len(inventory['files']))+" files in "+directory)
+    return(inventory)
+
+def inventory_files(realm,name_patterns):
+    #return the paths matching any of the (glob style) name_patterns
+    #results are indexed by realm and pattern so repeated lookups are free
     files=[]
-    #loop over all pattern is comma separated list
-    for pattern in patterns.split(','):
-        files.extend(glob.glob(data_dir+'/*'+pattern+'*'))
-
+    for name_pattern in name_patterns:
+        key=(realm,name_pattern)
+        if not key in inventory['index']:
+            names=fnmatch.filter(inventory['files'].keys(),name_pattern)
+            inventory['index'][key]=sorted([inventory['files'][name]['path'] for name in names])
+        files.extend(inventory['index'][key])
+    return(files)
+
+def realm_inventory(realm):
+    #all the files (with size and mtime) that have been selected for this realm
+    files={}
+    for (this_realm,name_pattern),paths in inventory['index'].items():
+        if this_realm==realm:
+            for path in paths:
+                files[path]=inventory['files'][os.path.basename(path)]
+    return(files)
+
+def static_signature(field):
+    #cheap signature of the horizontal grid of a field: the shape and edges of its
+    #latitude and longitude coordinates (reading the whole 2-D arrays would cost
+    #as much as the measures we are trying to avoid reading)
+    sha=hashlib.sha1()
+    for coord in field.coords().values():
+        if not (coord.Units.islatitude or coord.Units.islongitude):
+            continue
+        sha.update((str(coord.shape)+str(coord.Units)).encode())
+        if coord.ndim==2:
+            edges=[coord[0:1,:],coord[-1:,:],coord[:,0:1],coord[:,-1:]]
+        else:
+            edges=[coord]
+        for edge in edges:
+            sha.update(np.ascontiguousarray(edge.array).tobytes())
+    return(sha.hexdigest())
+
+def static_array(key,source):
+    #numpy array of a static grid quantity (cell area, latitudes...)
+    #read once per grid signature and kept in cache_dir as .npy files, so later
+    #cycles memory map them rather than reading and converting the netCDF again
+    key=key+(source.shape,)
+    if key in static_cache:
+        return(static_cache[key])
+
+    cache_file=None
+    if cache_dir:
+        key_hash=hashlib.sha1(str(key).encode()).hexdigest()
+        cache_file=os.path.join(cache_dir,'static',key[0]+'_'+key[1]+'_'+key_hash)
+    if cache_file is not None and os.path.exists(cache_file+'_data.npy'):
+        data=np.load(cache_file+'_data.npy',mmap_mode='r')
+        mask=np.ma.nomask
+        if os.path.exists(cache_file+'_mask.npy'):
+            mask=np.load(cache_file+'_mask.npy',mmap_mode='r')
+        array=np.ma.MaskedArray(data,mask=mask,copy=False)
+    else:
+        array=np.ma.asarray(source.array)
+        if cache_file is not None:
+            save_cache_array(cache_file+'_data.npy',np.ma.getdata(array))
+            if np.ma.is_masked(array):
+                save_cache_array(cache_file+'_mask.npy',np.ma.getmaskarray(array))
+    static_cache[key]=array
+    return(array)
+
+def read_unaggregated(file):
+    return(cf.read(file,aggregate=False))
+
+def read_files(files):
     if len(files)>0:
-        data=cf.read(files)
+        if monitor_io.read_workers>1 and len(files)>1:
+            #read the files concurrently (MONITOR_READ_WORKERS) and aggregate once
+            data=cf.FieldList()
+            for fieldlist in monitor_io.map_files(read_unaggregated,files):
+                data.extend(fieldlist)
+            data=cf.aggregate(data)
+        else:
+            data=cf.read(files)
         return(data)
     else:
         return(0)
 
-def read_ocean(stream,patterns):
-    #Read in All ocean files
-    files=[]
+def cice_files(patterns):
+    #loop over all pattern is comma separated list
+    return(inventory_files('ice',['*'+pattern+'*' for pattern in patterns.split(',')]))
 
+def ocean_files(stream,patterns):
     #loop over all pattern is comma separated list
-    for pattern in patterns.split(','):
-        files.extend(glob.glob(data_dir+'/*'+pattern+'*'+stream+'*'))
+    return(inventory_files('ocean',['*'+pattern+'*'+stream+'*' for pattern in patterns.split(',')]))
 
-    if len(files)>0:
-        data=cf.read(files)
-        return(data)
-    else:
-        return(0)
+def monthly_atm_files(patterns):
+    #loop over all pattern is comma separated list
+    return(inventory_files('atm',['*'+pattern+'*' for pattern in patterns.split(',')]))
 
-def read_monthly_atm(patterns):
+def stream_files(streams):
+    #now we match for *a_<NUMBER>_<STREAM>__*
+    #Number =0-99
+    #stream = mon day 1hr
+    #this exludes all the other monthly, daily and hourly files
+    return(inventory_files('atm',['*a_'+stream+'_1*' for stream in streams]))
 
-    #read in atmosphere files for a particular stream
-    files=[]
-    #loop over all pattern is comma separated list
-    for pattern in patterns.split(','):
-        files.extend(glob.glob(data_dir+'/*'+pattern+'*'))
+def read_cice(patterns):
+    #read in cice files
+    return(read_files(cice_files(patterns)))
 
+def read_ocean(stream,patterns):
+    #Read in All ocean files
+    return(read_files(ocean_files(stream,patterns)))
 
-    if len(files)>0:
-        data=cf.read(files)
-        return(data)
-    else:
-        return(0)
+def read_monthly_atm(patterns):
+    #read in atmosphere files for a particular stream
+    return(read_files(monthly_atm_files(patterns)))
 
 def read_streams(streams):
     #read in atmosphere files for a particular stream
-    files=[]
-    for stream in streams:
-        #now we match for *a_<NUMBER>_<STREAM>__*
-        #Number =0-99
-        #stream = mon day 1hr
-        #this exludes all the other monthly, daily and hourly files
-        files.extend(glob.glob(data_dir+'/*a_'+stream+'_1*'))
-     
-    if len(files)>0:
-        data=cf.read(files)
-        return(data)
-    else:
-        return(0)
+    return(read_files(stream_files(streams)))
 
 def get_ocean(ocean_variables,patterns):
     ###OCEAN
@@ -184,14 +681,17 @@ def get_ocean(ocean_variables,patterns):
     print("Reading Ocean Data..")
 
     #Loop over all grids
+    grid_data={}
     for grid in ocean_variables:
         print(grid)
         #Read in all data from this grid
-        data_ocean=read_ocean(grid,patterns)
+        with stage('read ocean '+grid):
+            data_ocean=read_ocean(grid,patterns)
 
         if data_ocean==0:
             print("Ocean "+grid+" data missing??")
             exit(99)
+        grid_data[grid]=data_ocean
         #We'll treat diaptr (AMOC) differently
         if not 'diaptr' in grid:
 
@@ -228,7 +728,13 @@ def get_ocean(ocean_variables,patterns):
                         print("No cell area measure found in cell_thickness")
                         exit()
 
-            cell_volume_measure=compute_cell_volume_measure(cell_thickness,cell_area)
+            #cell area is static - only read it for the first cycle on this grid
+            if isinstance(cell_area,cf.FieldList):
+                cell_area=cell_area[0]
+            cell_area=static_array(('ocean','cell_area',static_signature(cell_thickness[0])),cell_area)
+
+            if memory_budget is None:
+                cell_volume_measure=compute_cell_volume_measure(cell_thickness,cell_area)
 
         
         these_variables=ocean_variables[grid]
@@ -243,13 +749,20 @@ def get_ocean(ocean_variables,patterns):
                 fix_time_axis(data_ocean_var)
 
     
-                ocean_index=ocean_depth_mean(data_ocean_var,cell_volume_measure)  
+                with stage('reduce ocean '+variable):
+                    if memory_budget is None:
+                        ocean_index=ocean_depth_mean(data_ocean_var,cell_volume_measure)  
+                    else:
+                        ocean_index=ocean_depth_mean_streaming(data_ocean_var,cell_thickness,cell_area)
+                    persist(ocean_index)
                 ocean_list.append(ocean_index)
             else:
 
                 print("Process diaptr")
                 if 'meridional_streamfunction_atlantic' in variable:
-                    ocean_index=get_amoc_45N(data_ocean)
+                    with stage('derived amoc'):
+                        ocean_index=get_amoc_45N(data_ocean,ocean_files(grid,patterns),grid_data.get(ocn_t_grid))
+                        persist([ocean_index])
                     ocean_list.append(ocean_index)
 
     return(ocean_list)
@@ -257,7 +770,8 @@ def get_ocean(ocean_variables,patterns):
 def get_ice(ice_patterns):
     ice_list=cf.FieldList()
     print("Reading sea ice files")
-    sea_ice_data_monthly=read_cice(ice_patterns)
+    with stage('read ice'):
+        sea_ice_data_monthly=read_cice(ice_patterns)
 
 
     if sea_ice_data_monthly==0:
@@ -279,18 +793,255 @@ def get_ice(ice_patterns):
 
     #if no cell area is defined - try and extract from the tarea varible
     if not has_cell_area:
-        cell_area=cf.CellMeasure(data=sea_ice_data_monthly.select_by_ncvar('tarea')[0])
+        tarea=sea_ice_data_monthly.select_by_ncvar('tarea')[0]
+        #tarea is static - only read it for the first cycle on this grid
+        cell_area=cf.CellMeasure(data=cf.Data(static_array(('ice','tarea',static_signature(tarea)),tarea),units=tarea.Units))
         cell_area.units='m2'
         cell_area.measure='area'
         aice.set_construct(cell_area)
     
     aice.standard_name='sea_ice_area_fraction'
-    variable_area=area_integral_seaice(aice,job)
+    with stage('derived sea ice area'):
+        variable_area=persist(area_integral_seaice(aice,job))
     ice_list.extend(variable_area)
     return(ice_list)
 
 
 
+#UM STASH codes as they appear in the netCDF variable names e.g. m01s03i236
+stash_code_pattern=re.compile(r'm01s\d\di\d\d\d')
+
+def build_stash_index(fieldlist):
+    #one pass over the fields, indexing each one by the STASH code(s) in its ncvar
+    #so each variable lookup is a dictionary lookup, rather than a regex scan of
+    #the whole FieldList
+    stash_index={}
+    for field in fieldlist:
+        ncvar=field.nc_get_variable(None)
+        if ncvar is None:
+            continue
+        for stash_code in sorted(set(stash_code_pattern.findall(ncvar))):
+            if not stash_code in stash_index:
+                stash_index[stash_code]=cf.FieldList()
+            stash_index[stash_code].append(field)
+    return(stash_index)
+
+def stream_file_index(file):
+    return(build_stash_index(cf.read(file)))
+
+def stream_index(stream):
+    #STASH index of each file of a daily/hourly stream, built once per cycle
+    #the files are only opened for their metadata here
+    if not stream in inventory['streams']:
+        inventory['streams'][stream]=monitor_io.map_files(stream_file_index,stream_files([stream]))
+    return(inventory['streams'][stream])
+
+def accumulate_months(field,sums,counts,budget):
+    #add one file's field into the running monthly sums and counts
+    #the data is read a few time steps at a time, so at most about budget bytes
+    #are held whatever the length and resolution of the file
+    t_axis=field.get_data_axes().index(field.domain_axis('T',key=True))
+    time=field.dimension_coordinate('T')
+    months=time.year.array*100+time.month.array
+    #a point needs ~3 float64s: the data, its mask and the filled copy
+    step_bytes=max(1,field.size//field.shape[t_axis])*3*8
+    steps=max(1,int(budget//step_bytes))
+    for start in range(0,field.shape[t_axis],steps):
+        stop=min(start+steps,field.shape[t_axis])
+        index=[slice(None)]*field.ndim
+        index[t_axis]=slice(start,stop)
+        chunk=np.ma.moveaxis(np.ma.asarray(field[tuple(index)].array).astype(np.float64),t_axis,0)
+        for month in np.unique(months[start:stop]):
+            part=chunk[months[start:stop]==month]
+            if not month in sums:
+                sums[month]=np.zeros(part.shape[1:])
+                counts[month]=np.zeros(part.shape[1:])
+            sums[month]+=np.ma.filled(part,0.0).sum(axis=0)
+            counts[month]+=(~np.ma.getmaskarray(part)).sum(axis=0)
+
+def monthly_from_streams(stash_code):
+    #monthly means of a STASH code from the first fallback stream that has it
+    #the sums are accumulated file by file; cf only builds the (lazy) monthly
+    #collapse so the result has the same metadata as field.collapse(group=cf.M())
+    budget=memory_budget
+    if budget is None:
+        budget=fallback_budget
+    for stream in fallback_streams:
+        fields=cf.FieldList()
+        sums={}
+        counts={}
+        for file_index in stream_index(stream):
+            if not stash_code in file_index:
+                continue
+            field=file_index[stash_code][0]
+            fields.append(field)
+            accumulate_months(field,sums,counts,budget)
+        if len(fields)==0:
+            continue
+
+        print(stash_code+' found in '+stream+' data')
+        print("Converting to monthly means")
+        field=cf.aggregate(fields,relaxed_identities=True)
+        if len(field)>1:
+            print(stash_code+" has more than one entry in "+stream+" data - selecting the first occurrence")
+        field=field[0]
+        t_axis=field.get_data_axes().index(field.domain_axis('T',key=True))
+        monthly=field.collapse('time: mean',group=cf.M())
+        if monthly.shape[t_axis]!=len(sums):
+            print("Months of "+stash_code+" in "+stream+" data don't match the monthly collapse - skipping it")
+            continue
+        means=[]
+        for month in sorted(sums):
+            means.append(np.ma.masked_where(counts[month]==0,sums[month]/np.where(counts[month]==0,1,counts[month])))
+        set_collapsed_data(monthly,np.ma.moveaxis(np.ma.stack(means),0,t_axis))
+        return(cf.FieldList([monthly]))
+    return(cf.FieldList())
+
+def stash_code_of(variable):
+    #STASH item number (section*1000+item) to the code in the netCDF variable names
+    var_str=str(variable).rjust(5,'0')
+    return('m01s'+var_str[:-3]+'i'+var_str[-3:])
+
+def mask_file_values(mask_file,mask_variable):
+    #a basin or land/sea mask, flattened - read once per run
+    key=('mask',mask_file,mask_variable)
+    if not key in static_cache:
+        with netCDF4.Dataset(mask_file) as nc:
+            static_cache[key]=np.ma.filled(np.ma.asarray(nc.variables[mask_variable][:]).squeeze(),0).ravel()
+    return(static_cache[key])
+
+def region_mask(name,latitude,longitude):
+    #boolean mask of the points (latitude and longitude flattened in the same
+    #order as the data) in a region of the library
+    region=region_library[name]
+    kind=region['type']
+    if kind=='global':
+        return(np.ones(latitude.shape,dtype=bool))
+    if kind=='hemisphere':
+        if region['side']=='north':
+            return(latitude>0)
+        return(latitude<0)
+    if kind=='band':
+        return((latitude>=region['south'])&(latitude<=region['north']))
+    if kind=='box':
+        west,east,south,north=region['box']
+        if east-west>=360:
+            in_lon=np.ones(longitude.shape,dtype=bool)
+        else:
+            #longitudes may be -180:180 or 0:360
+            in_lon=np.mod(longitude-west,360)<=np.mod(east-west,360)
+        return(in_lon&(latitude>=south)&(latitude<=north))
+    values=mask_file_values(region['mask_file'],region['mask_variable'])
+    if values.size!=latitude.size:
+        raise ValueError("Region "+name+": "+region['mask_file']+" has "+str(values.size)+" points, the grid has "+str(latitude.size))
+    if kind=='basin':
+        return(values==region['value'])
+    if kind=='land':
+        return(values>region['threshold'])
+    return(values<=region['threshold'])
+
+def region_matrix(signature,names,latitude,longitude,weights=None):
+    #sparse (points,regions) matrix of the weights (or 1) of the points in each
+    #region - compiled once per grid, so one product reduces over every region
+    key=(signature,tuple(names),weights is None)
+    if not key in region_matrices:
+        rows=[]
+        columns=[]
+        values=[]
+        for n,name in enumerate(names):
+            mask=np.ma.filled(region_mask(name,np.ma.asarray(latitude),np.ma.asarray(longitude)),False)
+            if weights is not None:
+                mask=mask&(weights!=0)
+            points=np.flatnonzero(mask)
+            rows.append(points)
+            columns.append(np.full(points.size,n))
+            if weights is None:
+                values.append(np.ones(points.size))
+            else:
+                values.append(weights[points])
+        region_matrices[key]=scipy.sparse.csr_matrix((np.concatenate(values),(np.concatenate(rows),np.concatenate(columns))),shape=(latitude.size,len(names)))
+    return(region_matrices[key])
+
+def region_sums(array,matrix):
+    #(rows,points) array times a sparse (points,regions) matrix, as a (rows,regions) array
+    return(np.asarray((matrix.T@array.T).T))
+
+def region_means(stack,matrix):
+    #weighted means over each region of a masked (rows,points) array
+    #masked points contribute to neither the sum nor the total weight
+    region_sum=region_sums(np.ma.filled(stack,0.0),matrix)
+    region_weight=region_sums((~np.ma.getmaskarray(stack)).astype(np.float64),matrix)
+    return(np.ma.masked_where(region_weight==0,region_sum/np.where(region_weight==0,1.0,region_weight)),
+           np.ma.masked_where(region_weight==0,region_sum))
+
+def grid_points(field):
+    #latitude and longitude of each (Y,X) point of a field with 1-D coordinates
+    longitude,latitude=np.meshgrid(field.dimension_coordinate('X').array,field.dimension_coordinate('Y').array)
+    return(latitude.ravel(),longitude.ravel())
+
+def evaluate_indices(indices,sources,job):
+    #regional indices from the registry
+    #indices are grouped by source field and grid, so each field is read and its
+    #weights computed once; all the regions of a group are reduced together with one
+    #sparse (time,points)x(points,regions) product
+    index_list=cf.FieldList()
+    groups={}
+    for index in indices:
+        field=sources.get(index['source'])
+        if field is None:
+            print("No data for index "+index['name']+" ("+stash_code_of(index['source'])+")")
+            continue
+        if not batchable(field):
+            print("Can't compute index "+index['name']+" - "+field.identity()+" is not a (time,Y,X) field")
+            continue
+        x_bounds=field.coord('X').create_bounds()
+        y_bounds=field.coord('Y').create_bounds()
+        field.coord('X').set_bounds(x_bounds)
+        field.coord('Y').set_bounds(y_bounds)
+        key=(index['source'],grid_signature([field.coord('Y'),field.coord('X')]))
+        if not key in groups:
+            groups[key]=[]
+        groups[key].append(index)
+
+    for (source,signature),members in groups.items():
+        field=sources[source]
+        with stage('reduce indices of '+stash_code_of(source)):
+            print("Regional indices "+', '.join(index['name'] for index in members)+" of "+field.identity())
+            names=[]
+            for index in members:
+                for name in (index['region'],index['minus_region']):
+                    if name is not None and not name in names:
+                        names.append(name)
+            latitude,longitude=grid_points(field)
+            matrix=region_matrix(signature,names,latitude,longitude,area_weights_array(field).astype(np.float64).ravel())
+
+            values={}
+            values['mean'],values['sum']=region_means(field_to_tyx(field),matrix)
+
+            templates={}
+            for index in members:
+                reduction=index['reduction']
+                if not reduction in templates:
+                    templates[reduction]=field.collapse('area: '+reduction,weights=area_weights(field),squeeze=True)
+                series=values[reduction][:,names.index(index['region'])]
+                region=index['region']
+                if index['minus_region'] is not None:
+                    series=series-values[reduction][:,names.index(index['minus_region'])]
+                    region+=' minus '+index['minus_region']
+
+                index_field=set_collapsed_data(templates[reduction].copy(),series)
+                if index['season'] is not None:
+                    in_season=np.isin(index_field.coord('T').month.array,index['season'])
+                    if not in_season.any():
+                        print("No "+index['name']+" months in this cycle")
+                        continue
+                    index_field=index_field[in_season].collapse('time: mean',group=cf.Y())
+                index_field.standard_name=index['name']
+                index_field.set_properties({'job': job,'region':region})
+                index_list.append(index_field)
+            persist(index_list)
+    return(index_list)
+
 def get_atm(atm_variables,atm_patterns):
     atm_list=cf.FieldList()
     print("Reading Atmosphere Data")
@@ -298,7 +1049,8 @@ def get_atm(atm_variables,atm_patterns):
     no_data=True
 
     print("Reading files monthly ATM ")
-    data_monthly=read_monthly_atm(atm_patterns)
+    with stage('read atm'):
+        data_monthly=read_monthly_atm(atm_patterns)
 
     if data_monthly==0:
         print("No Monthly ATM data")
@@ -323,42 +1075,29 @@ def get_atm(atm_variables,atm_patterns):
         if len(monthly_means)==0:
             print("Failed to find any ATM fields!")
             exit(99)
-            
+
+    stash_index=build_stash_index(monthly_means)
+    selected_variables=cf.FieldList()
 
     
+    #fields the registry indices are computed from, keyed by STASH item number
+    sources={}
     for variable in atm_variables:
 
-        var_str=str(variable).rjust(5,'0')
-        stash_code='m01s'+var_str[:-3]+'i'+var_str[-3:]
+        stash_code=stash_code_of(variable)
 
 
-        select_variable=monthly_means.select_by_ncvar(re.compile(stash_code))
+        select_variable=stash_index.get(stash_code,cf.FieldList())
         found_flag=True
         if len(select_variable)==0:
-             print('No entry for '+stash_code)
-             found_flag=False
-#            print('No entry for '+stash_code+'  checking daily..')
-#            select_variable_daily=data_daily.select_by_ncvar(re.compile(stash_code))
-#            if len(select_variable_daily)==0:
-#                print('No entry for '+stash_code+'  in daily data checking hourly')
-#                select_variable_hourly=data_hourly.select_by_ncvar(re.compile(stash_code))
-#                if len(select_variable_hourly)==0:
-#                    print('No entry for '+stash_code+'  in hourly data ')
-#                    found_flag=False
-#                else:
-#                    print(stash_code+' found in hourly data')
-#                    select_variable=cf.FieldList()
-#                    print("Converting to monthly means")
-#                    for field in select_variable_hourly:
-#                        select_variable.append(field.collapse('time: mean',group=cf.M()))
-#            else:
-#                print(stash_code+' found in daily data')
-#                select_variable=cf.FieldList()
-#                print("Converting to monthly means")
-#
-#                for field in select_variable_daily:
-#                    select_variable.append(field.collapse('time: mean',group=cf.M()))
-
+             print('No entry for '+stash_code+'  checking '+' and '.join(fallback_streams)+' data..')
+             with stage('reduce atm '+stash_code+' to monthly'):
+                 select_variable=monthly_from_streams(stash_code)
+             if len(select_variable)==0:
+                 print('No entry for '+stash_code+'  in '+' or '.join(fallback_streams)+' data')
+                 found_flag=False
+             else:
+                 select_variable_ag=select_variable
 
         else:
             select_variable_ag=cf.aggregate(select_variable,relaxed_identities=True)
@@ -374,9 +1113,20 @@ def get_atm(atm_variables,atm_patterns):
                 this_variable.standard_name=this_variable.properties()['long_name'].replace(' ','_').replace('/','_').replace(':','_')
             print(stash_code+': '+this_variable.standard_name)
 
+            selected_variables.append(this_variable)
+            sources[variable]=this_variable
+
+    #area means of all the selected variables
+    atm_list.extend(area_means(selected_variables,job))
+
+    #regional indices - their sources are usually among the variables already selected
+    for index in atm_indices:
+        if not index['source'] in sources:
+            select_variable=cf.aggregate(stash_index.get(stash_code_of(index['source']),cf.FieldList()),relaxed_identities=True)
+            if len(select_variable)>0:
+                sources[index['source']]=select_variable[0]
+    atm_list.extend(evaluate_indices(atm_indices,sources,job))
 
-            variable_area_mean=area_mean(this_variable,job)
-            atm_list.append(variable_area_mean)
     ##MASS CONTENT OF WATER IN SOIL
     #compute mass_content_of_water_in_soil
     #CMIP6 stores total mass_content_of_water_in_soil
@@ -386,9 +1136,11 @@ def get_atm(atm_variables,atm_patterns):
     if len(soil_moisture)>0:
         print("Soil moisture! Computing sum over layers for CMIP")
 
-        soil_moisture_total=soil_moisture[0].collapse('depth: sum',squeeze=True)
-        #need to rename to cmip
-        soil_moisture_total.standard_name='mass_content_of_water_in_soil'
+        with stage('derived soil moisture'):
+            soil_moisture_total=soil_moisture[0].collapse('depth: sum',squeeze=True)
+            #need to rename to cmip
+            soil_moisture_total.standard_name='mass_content_of_water_in_soil'
+            persist([soil_moisture_total])
         atm_list.append(soil_moisture_total)
     else:
         print("NO SOIL MOISTURE DATA")
@@ -399,8 +1151,10 @@ def get_atm(atm_variables,atm_patterns):
     rlut=atm_list.select('toa_outgoing_longwave_flux')
 
     if len(rsdt)>0 and len(rsut)>0 and len(rlut)>0:
-        net_toa=rsdt[0]-rsut[0]-rlut[0]
-        net_toa.standard_name='toa_net_incoming_flux'
+        with stage('derived net toa'):
+            net_toa=rsdt[0]-rsut[0]-rlut[0]
+            net_toa.standard_name='toa_net_incoming_flux'
+            persist([net_toa])
         atm_list.append(net_toa)
     else:
         print("NOT enough Radiation data for TOA calculation")
@@ -444,7 +1198,7 @@ def fix_axes(cf_field):
 def compute_cell_volume_measure(cell_thickness_fieldlist,cell_area):
     cell_volume_fieldlist=cf.FieldList()
     for field in cell_thickness_fieldlist:
-        cell_volume_np=cell_area.array*field.array
+        cell_volume_np=cell_area*field.array
         #create CellMeasure
         cell_volume=cf.CellMeasure(data=cf.Data(np.squeeze(cell_volume_np)))
         cell_volume.units="m3"
@@ -465,6 +1219,91 @@ def ocean_depth_mean(field_list,cell_measure_volume_list):
         ocean_mean.standard_name='global_mean_'+ocean_mean.standard_name
         ocean_depth_mean_list.append(ocean_mean)
 
+        if len(statistics)>0:
+            #read the field once and compute the mean with the statistics, rather
+            #than letting cf read it again for the mean
+            #the volume is laid out like the field - (...,depth,Y,X)
+            variable=np.ma.asarray(field.array)
+            volume=np.ma.filled(np.ma.asarray(cell_volume.array),0.0)
+            rows=int(np.prod(field.shape[:-3]))
+            results=weighted_statistics(variable.reshape(rows,-1),np.broadcast_to(volume,field.shape).reshape(rows,-1),statistics)
+            set_collapsed_data(ocean_mean,results['mean'])
+            for name in statistics:
+                ocean_depth_mean_list.append(statistic_field(ocean_mean,name,results[name]))
+
+    ocean_mean=cf.aggregate(ocean_depth_mean_list)
+    return(ocean_mean)
+
+
+def volume_chunks(shape,budget):
+    #index tuples covering an array of this shape, split along the depth (and
+    #time) axes so each chunk needs about budget bytes of working memory
+    #the last three axes are (depth,Y,X); anything before that is looped over
+    #a point needs ~4 float64s: variable, thickness, volume and their product
+    plane_bytes=shape[-1]*shape[-2]*4*8
+    levels=max(1,int(budget//plane_bytes))
+    if levels==1 and plane_bytes>budget:
+        print("Memory budget is smaller than one level - reading a level at a time")
+    chunks=[]
+    for leading in np.ndindex(*shape[:-3]):
+        for level in range(0,shape[-3],levels):
+            chunks.append((leading,tuple(leading)+(slice(level,level+levels),slice(None),slice(None))))
+    return(chunks)
+
+def ocean_depth_mean_streaming(field_list,cell_thickness_fieldlist,cell_area):
+    #same as ocean_depth_mean, but the volume weighted sum and the total volume
+    #are accumulated chunk by chunk, so the full volume is never held in memory
+    ocean_depth_mean_list=cf.FieldList()
+    for field, cell_thickness in zip(field_list, cell_thickness_fieldlist):
+        if field.shape!=cell_thickness.shape or field.ndim<3:
+            print("Can't stream "+field.identity()+" - computing the volume in memory")
+            ocean_depth_mean_list.extend(ocean_depth_mean(cf.FieldList([field]),compute_cell_volume_measure(cf.FieldList([cell_thickness]),cell_area)))
+            continue
+
+        weighted_sum=np.zeros(field.shape[:-3])
+        total_volume=np.zeros(field.shape[:-3])
+        #running minimum, maximum and volume weighted sum of squares for the statistics
+        minimum=np.full(field.shape[:-3],np.inf)
+        maximum=np.full(field.shape[:-3],-np.inf)
+        weighted_squares=np.zeros(field.shape[:-3])
+        for leading,index in volume_chunks(field.shape,memory_budget):
+            variable=np.ma.asarray(field[index].array).astype(np.float64)
+            volume=cell_area*np.ma.asarray(cell_thickness[index].array)
+            #masked points contribute to neither sum
+            valid=~(np.ma.getmaskarray(variable)|np.ma.getmaskarray(volume))
+            volume=np.where(valid,np.ma.filled(volume,0.0),0.0)
+            values=np.where(valid,np.ma.filled(variable,0.0),0.0)
+            weighted_sum[leading]+=np.sum(values*volume)
+            total_volume[leading]+=np.sum(volume)
+            if len(statistics)>0 and valid.any():
+                minimum[leading]=min(minimum[leading],values[valid].min())
+                maximum[leading]=max(maximum[leading],values[valid].max())
+                weighted_squares[leading]+=np.sum(values**2*volume)
+        mean=np.ma.masked_where(total_volume==0,weighted_sum/np.where(total_volume==0,1.0,total_volume))
+
+        #cf builds the collapsed field from a lazy volume measure - nothing is computed,
+        #but the metadata is exactly what ocean_depth_mean writes
+        cell_volume=cf.CellMeasure(data=(cell_thickness.data*cf.Data(cell_area)).squeeze())
+        cell_volume.units="m3"
+        cell_volume.measure="volume"
+        field.set_construct(cell_volume)
+        fix_axes(field)
+        ocean_mean=field.collapse('volume: mean', measure=True,squeeze=True)
+        set_collapsed_data(ocean_mean,mean)
+        ocean_mean.standard_name='global_mean_'+ocean_mean.standard_name
+        ocean_depth_mean_list.append(ocean_mean)
+
+        empty=total_volume==0
+        streamed={'min':np.ma.masked_where(empty,minimum),
+                  'max':np.ma.masked_where(empty,maximum),
+                  'std':np.ma.sqrt(np.ma.maximum(weighted_squares/np.where(empty,1.0,total_volume)-mean**2,0.0))}
+        for name in statistics:
+            if not name in streamed:
+                #a percentile needs all the values at once
+                print("Can't stream the "+name+" of "+field.identity()+" - unset MONITOR_MEMORY_BUDGET_MB for percentiles")
+                continue
+            ocean_depth_mean_list.append(statistic_field(ocean_mean,name,streamed[name]))
+
     ocean_mean=cf.aggregate(ocean_depth_mean_list)
     return(ocean_mean)
 
@@ -548,52 +1387,207 @@ def area_integral_seaice(field,job):
             exit(99)
     measure=measure0.value()
 
-    m_area=measure.array
+    #the cell area and latitudes don't change from cycle to cycle
+    signature=static_signature(field)
+    m_area=static_array(('ice','area',signature),measure)
     area_masked=np.ma.masked_array(m_area,mask=m_area==0)
     field.cell_measure().data[:]=cf.Data(area_masked,units='m^2')
     ## NEED TO FIX THIS
 
 
+    #all the sea ice areas come from one pass over the masked aice*area product:
+    #global, the two hemispheres, any extra latitude bands and seaice_regions
+    regions=[('global_sea_ice_area','global'),
+             ('northern_sea_ice_area','northern_hemisphere'),
+             ('southern_sea_ice_area','southern_hemisphere')]
+    for name,south,north in seaice_bands:
+        region_library[name]={'type':'band','south':south,'north':north}
+        regions.append((name+'_sea_ice_area',name))
+    for name in seaice_regions:
+        regions.append((name+'_sea_ice_area',name))
+
+    #put the horizontal axes last, in the same order for data, latitude and area
+    data_axes=field.get_data_axes()
+    lat_key=field.aux('latitude',key=True)
+    lat_axes=field.get_data_axes(lat_key)
+    horizontal_axes=[axis for axis in data_axes if axis in lat_axes]
+    other_axes=[axis for axis in data_axes if not axis in lat_axes]
+    aice=np.ma.transpose(np.ma.asarray(field.array),[data_axes.index(axis) for axis in other_axes+horizontal_axes])
+    aice=aice.reshape(-1,int(np.prod([field.domain_axis(axis).size for axis in horizontal_axes])))
+    latitude=np.ma.transpose(static_array(('ice','latitude',signature),field.aux('latitude')),[lat_axes.index(axis) for axis in horizontal_axes]).ravel()
+    measure_axes=field.get_data_axes(measure0.key())
+    area=np.ma.transpose(area_masked,[measure_axes.index(axis) for axis in horizontal_axes]).ravel()
+    longitude=None
+    if any(region_library[region]['type']=='box' for name,region in regions):
+        lon_axes=field.get_data_axes(field.aux('longitude',key=True))
+        longitude=np.ma.transpose(static_array(('ice','longitude',signature),field.aux('longitude')),[lon_axes.index(axis) for axis in horizontal_axes]).ravel()
+
+    #one sparse column per region
+    matrix=region_matrix(signature,[region for name,region in regions],latitude,longitude)
+
+    product=aice.astype(np.float64)*area
+    region_integrals=region_sums(np.ma.filled(product,0.0),matrix)
+    region_points=region_sums((~np.ma.getmaskarray(product)).astype(np.float64),matrix)
+    region_integrals=np.ma.masked_where(region_points==0,region_integrals)
+
+    #cf builds the (lazy) global collapsed field once - the other regions are copies
+    #holding their own values, rather than collapses of a subspace of the field.
+    #The hemispheres keep the latitude subspace they have always been written with
+    template=field.collapse('area: integral',weights='area',measure=True,squeeze=True)
+    hemispheres={'northern_hemisphere':cf.gt(0),'southern_hemisphere':cf.lt(0)}
     integrals=cf.FieldList()
-    integral=field.collapse('area: integral',weights='area',measure=True,squeeze=True)
-    #convert to Mega m^2 (10^12 m^2)
-    integral.units='Mm2'
-    integral.set_properties({'job': job})
-    integral.standard_name='global_sea_ice_area'
-    integrals.append(integral)
-
-    field_N=field.subspace(latitude=cf.gt(0))
-    integral_N=field_N.collapse('area: integral',weights='area',measure=True,squeeze=True)
-    integral_N.units='Mm2'
-    integral_N.standard_name='northern_sea_ice_area'
-    integral_N.set_properties({'job': job})
-    integrals.append(integral_N)
-
+    for n,(name,region) in enumerate(regions):
+        if region=='global':
+            integral=set_collapsed_data(template.copy(),region_integrals[:,n])
+        elif region in hemispheres:
+            integral=field.subspace(latitude=hemispheres[region]).collapse('area: integral',weights='area',measure=True,squeeze=True)
+            set_collapsed_data(integral,region_integrals[:,n])
+        else:
+            integral=set_collapsed_data(template.copy(),region_integrals[:,n])
+            integral.set_property('region',region)
+        #convert to Mega m^2 (10^12 m^2)
+        integral.units='Mm2'
+        integral.set_properties({'job': job})
+        integral.standard_name=name
+        integrals.append(integral)
+
+        if len(statistics)>0:
+            #statistics of the ice fraction over the region, weighted by cell area
+            results=weighted_statistics(aice,np.ma.filled(area,0.0)*matrix[:,n].toarray().ravel(),statistics)
+            #the copy holds Mm2 - relabel it (no conversion) as a fraction
+            fraction=integral.copy()
+            fraction.override_units(field.Units,inplace=True)
+            fraction.standard_name=name.replace('_sea_ice_area','_sea_ice_area_fraction')
+            for statistic in statistics:
+                integrals.append(statistic_field(fraction,statistic,results[statistic]))
 
-    field_S=field.subspace(latitude=cf.lt(0))
-    integral_S=field_S.collapse('area: integral',weights='area',measure=True,squeeze=True)
-    integral_S.units='Mm2'
-    integral_S.standard_name='southern_sea_ice_area'
-    integral_S.set_properties({'job': job})
-    integrals.append(integral_S)
+    return(integrals)
 
 
-    return(integrals)
+def read_jline(files,ncvar,jline):
+    #read only row jline of ncvar, straight from each netCDF file, and join the
+    #files in time order - returns (time,depth,x) or (time,depth) if there is no x axis
+    slabs=[]
+    for file in files:
+        with netCDF4.Dataset(file) as nc:
+            if not ncvar in nc.variables:
+                continue
+            var=nc.variables[ncvar]
+            if var.ndim==4:
+                slab=var[:,:,jline,:]
+            else:
+                slab=var[:,:,jline]
+            #sort on the first time value, as cf.aggregate does
+            time_name=var.dimensions[0]
+            first_time=None
+            if time_name in nc.variables and hasattr(nc.variables[time_name],'units'):
+                time_var=nc.variables[time_name]
+                first_time=netCDF4.num2date(time_var[0],time_var.units,getattr(time_var,'calendar','standard'))
+            slabs.append((first_time,file,np.ma.asarray(slab)))
+    if len(slabs)==0:
+        return(None)
+    if any(slab[0] is None for slab in slabs):
+        #no times to compare - use the file names
+        slabs.sort(key=lambda slab: slab[1])
+    else:
+        slabs.sort(key=lambda slab: (slab[0],slab[1]))
+    return(np.ma.concatenate([slab[2] for slab in slabs]))
+
+def read_amoc_jlines():
+    #jline lookup saved by earlier runs
+    global amoc_jlines
+    if amoc_jlines is None:
+        amoc_jlines={}
+        if cache_dir and os.path.exists(os.path.join(cache_dir,'amoc_jlines.json')):
+            with open(os.path.join(cache_dir,'amoc_jlines.json')) as f:
+                amoc_jlines=json.load(f)
+    return(amoc_jlines)
+
+def save_amoc_jlines():
+    if not cache_dir:
+        return
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    jline_file=os.path.join(cache_dir,'amoc_jlines.json')
+    tmp_file=jline_file+'.'+str(os.getpid())+'.tmp'
+    with open(tmp_file,'w') as f:
+        json.dump(amoc_jlines,f,indent=1,sort_keys=True)
+    os.replace(tmp_file,jline_file)
+
+def nearest_row(latitude_rows,latitude):
+    #index of the row whose latitude is closest to latitude
+    return(int(np.nanargmin(np.abs(np.asarray(latitude_rows,dtype=float)-latitude))))
+
+def jline_from_t_grid(t_grid_data,ysize,latitude):
+    #use the 2-D T grid latitudes, averaged over the Atlantic sector of each row
+    for field in t_grid_data:
+        lat=field.aux('latitude',default=None)
+        lon=field.aux('longitude',default=None)
+        if lat is None or lon is None or lat.ndim!=2:
+            continue
+        lat=np.ma.filled(np.ma.asarray(lat.array,dtype=float),np.nan)
+        lon=np.ma.filled(np.ma.asarray(lon.array,dtype=float),np.nan)
+        if lat.shape[0]!=ysize and lat.shape[1]==ysize:
+            lat=lat.T
+            lon=lon.T
+        if lat.shape[0]!=ysize:
+            continue
+        lon=(lon+180.0)%360.0-180.0
+        atlantic=(lon>=-80.0)&(lon<=0.0)
+        rows=np.where(atlantic,lat,np.nan)
+        with np.errstate(invalid='ignore'):
+            counts=atlantic.sum(axis=1)
+            row_lat=np.where(counts>0,np.nansum(rows,axis=1)/np.maximum(counts,1),np.nan)
+        if np.all(np.isnan(row_lat)):
+            continue
+        return(nearest_row(row_lat,latitude))
+    return(None)
+
+def jline_from_diaptr(field,latitude):
+    #the diaptr latitudes - only trusted if they increase along j and span latitude
+    lat=np.ma.asarray(field.coord('latitude').array,dtype=float)
+    lat=np.ma.filled(lat.reshape(lat.shape[0],-1)[:,0],np.nan)
+    if np.any(np.isnan(lat)) or np.any(np.diff(lat)<=0):
+        return(None)
+    if not lat[0]<=latitude<=lat[-1]:
+        return(None)
+    return(nearest_row(lat,latitude))
+
+def amoc_jline(field,t_grid_data,latitude):
+    #jline closest to latitude for this diaptr grid
+    #worked out from the latitudes the first time a grid size is seen, then
+    #looked up in cache_dir/amoc_jlines.json
+    ysize=field.coord('latitude').shape[0]
+    key=str(ysize)+':'+format(latitude,'g')
+    jlines=read_amoc_jlines()
+    if key in jlines:
+        return(jlines[key])
+
+    jline=None
+    if latitude==45 and str(ysize) in amoc_45_mappings:
+        jline=int(amoc_45_mappings[str(ysize)])
+    if jline is None and t_grid_data is not None:
+        jline=jline_from_t_grid(t_grid_data,ysize,latitude)
+        if jline is not None:
+            print("AMOC jline from T grid latitudes: "+str(jline))
+    if jline is None:
+        jline=jline_from_diaptr(field,latitude)
+        if jline is not None:
+            print("AMOC jline from diaptr latitudes: "+str(jline))
+    if jline is None:
+        print("Can't work out the AMOC jline at "+format(latitude,'g')+" for a grid with "+str(ysize)+" rows")
+        exit(99)
 
+    jlines[key]=jline
+    save_amoc_jlines()
+    return(jline)
 
-def get_amoc_45N(data):
-    #compute AMOC at 45N 
-    #The diaptr file does not contain information about how the jlines coordinates map onto the mean lattude, so we need to do this manually, depending on the model resolution - estimated by the ncdim%y size
-    #Closest jline to 45N is j=2647 for H
-    #Closest jline to 45N is j=886 for M
-    #Closest jline to 45N is j= for L
-    #see /home/users/dlrhodso/CANARI/monitoring/get_amoc_45_jline.sh
-    amoc_45_mappings={'332':'251',
-                      '1207':'886',
-                      '3606':'2647'
-                  }
+def get_amoc_45N(data,files,t_grid_data=None):
+    #compute AMOC at 45N (or amoc_latitude)
+    #The diaptr file does not contain information about how the jlines coordinates map onto the mean lattude,
+    #so this is worked out from the T grid latitudes (see amoc_jline)
 
-    print("AMOC45")
+    print("AMOC"+format(amoc_latitude,'g'))
 
     data_ocean_var=data.select_by_ncvar('zomsfatl')
     if len(data_ocean_var)==0:
@@ -601,14 +1595,8 @@ def get_amoc_45N(data):
         exit(99)
 
 
-    #find jline at 45N
-    ysize=str(data_ocean_var[0].coord('latitude').array.shape[0])
-    if not ysize in amoc_45_mappings:
-        print("Unrecognised model resolution when computing AMOC 45N?")
-        print(ysize)
-     
-        exit()
-    amoc_45_jline=int(amoc_45_mappings[ysize])
+    #find jline at the target latitude
+    amoc_45_jline=amoc_jline(data_ocean_var[0],t_grid_data,amoc_latitude)
 
 
     #need to reduce x axis for GC3.1 but not UKESM ere
@@ -647,15 +1635,36 @@ def get_amoc_45N(data):
     #    exit()
     #amoc_45_jline=int(amoc_45_mappings[ysize])
 
-    squeeze_axes=[ x.identity() for x in amoc1[0].domain_axes().values() if not 'time' in x.identity()]
-    if reduce_x_axis:
-        amoc_m1=amoc1[0][:,:,amoc_45_jline,:].array.squeeze()
-        #find the first i that has a non-masked value along this jline
-        first_non_masked_i=np.ma.flatnotmasked_edges(amoc_m1)[0]
-        #get list of domain axes to squeeze (all but a time axis)
-        amoc_m=amoc1[0][:,:,amoc_45_jline,first_non_masked_i].collapse('depth: maximum').squeeze(squeeze_axes)
+    #only the jline row is needed - read just that hyperslab from the files,
+    #not the whole streamfunction
+    try:
+        amoc_row=read_jline(files,'zomsfatl',amoc_45_jline)
+    except Exception as error:
+        #anything odd in the files - the cf path below copes with more
+        print("Direct read of the AMOC jline failed: "+type(error).__name__+": "+str(error))
+        amoc_row=None
+    ntimes=amoc1[0].coord('time').size
+    if amoc_row is not None and amoc_row.shape[0]==ntimes:
+        if reduce_x_axis:
+            amoc_m1=amoc_row.squeeze()
+            #find the first i that has a non-masked value along this jline
+            first_non_masked_i=np.ma.flatnotmasked_edges(amoc_m1)[0]
+            amoc_column=amoc_row[:,:,first_non_masked_i]
+        else:
+            amoc_column=amoc_row.reshape(ntimes,-1)
+        #maximum over depth
+        amoc_m=cf.Data(amoc_column.max(axis=1))
     else:
-        amoc_m=amoc1[0][:,:,amoc_45_jline].collapse('depth: maximum').squeeze(squeeze_axes)
+        print("Can't read the AMOC jline directly from the files - using the aggregated field")
+        squeeze_axes=[ x.identity() for x in amoc1[0].domain_axes().values() if not 'time' in x.identity()]
+        if reduce_x_axis:
+            amoc_m1=amoc1[0][:,:,amoc_45_jline,:].array.squeeze()
+            #find the first i that has a non-masked value along this jline
+            first_non_masked_i=np.ma.flatnotmasked_edges(amoc_m1)[0]
+            #get list of domain axes to squeeze (all but a time axis)
+            amoc_m=amoc1[0][:,:,amoc_45_jline,first_non_masked_i].collapse('depth: maximum').squeeze(squeeze_axes)
+        else:
+            amoc_m=amoc1[0][:,:,amoc_45_jline].collapse('depth: maximum').squeeze(squeeze_axes)
 
 
     #Closest jline to 45N is j=885
@@ -664,45 +1673,725 @@ def get_amoc_45N(data):
     amoc_45.set_data(amoc_m)
     amoc_45.units='Sv'
     amoc_45.set_construct(amoc1[0].coord('time'))
-    amoc_45.standard_name='amoc_45n'
-    amoc_45.nc_set_variable('amoc45n')    
+    #amoc_45n for the default latitude
+    amoc_name=format(abs(amoc_latitude),'g')+('n' if amoc_latitude>=0 else 's')
+    amoc_45.standard_name='amoc_'+amoc_name
+    amoc_45.nc_set_variable('amoc'+amoc_name)
     amoc_45.set_properties({'job': job})
     return(amoc_45)
 
     
+def grid_signature(coords):
+    #hash of the coordinate values, bounds and shapes that define a grid
+    sha=hashlib.sha1()
+    for coord in coords:
+        array=np.ascontiguousarray(coord.array)
+        sha.update((str(array.shape)+str(array.dtype)+str(coord.Units)).encode())
+        sha.update(array.tobytes())
+        if coord.has_bounds():
+            sha.update(np.ascontiguousarray(coord.bounds.array).tobytes())
+    return(sha.hexdigest())
+
+def save_cache_array(cache_file,array):
+    #write to a temporary file first, so a half written cache file is never read
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file),exist_ok=True)
+    tmp_file=cache_file+'.'+str(os.getpid())+'.tmp'
+    with open(tmp_file,'wb') as f:
+        np.save(f,array)
+    os.replace(tmp_file,cache_file)
+
+def area_weights_array(field):
+    #area weights for the (Y,X) grid of this field, as a (Y,X) numpy array
+    #nearly all the atmosphere variables share a grid, so the weights are computed
+    #once per grid signature and, if cache_dir is set, kept on disk for later cycles
+    x_axis=field.domain_axis('X',key=True)
+    y_axis=field.domain_axis('Y',key=True)
+
+    signature=grid_signature([field.coord('Y'),field.coord('X')])
+    if not signature in weights_cache:
+        cache_file=None
+        if cache_dir:
+            cache_file=os.path.join(cache_dir,'area_weights_'+signature+'.npy')
+        if cache_file is not None and os.path.exists(cache_file):
+            weights=np.load(cache_file)
+        else:
+            area=field.weights('area')
+            #always store as (Y,X)
+            weights=np.array(area.array)
+            if area.get_data_axes()==(x_axis,y_axis):
+                weights=weights.T
+            if cache_file is not None:
+                save_cache_array(cache_file,weights)
+        weights_cache[signature]=weights
+    return(weights_cache[signature])
+
+def area_weights(field):
+    #area weights for this field, in a form that collapse accepts
+    x_axis=field.domain_axis('X',key=True)
+    y_axis=field.domain_axis('Y',key=True)
+
+    if len(field.cell_measures().filter_by_measure('area'))>0:
+        #weights come from the field's own cell measure - don't cache these
+        return(field.weights('area'))
+
+    weights=area_weights_array(field)
+
+    #match the order of the axes in the field
+    data_axes=field.get_data_axes()
+    if data_axes.index(x_axis)<data_axes.index(y_axis):
+        return({(x_axis,y_axis):cf.Data(weights.T)})
+    return({(y_axis,x_axis):cf.Data(weights)})
+
+def weighted_statistics(values,weights,names):
+    #the weighted mean and the statistics of each row of a masked (rows,points)
+    #array, all from the one array already in memory. weights (points,) or
+    #(rows,points) are the cell areas or volumes; masked points and points with
+    #no weight (e.g. outside the region) are ignored
+    data=np.ma.filled(values,0.0).astype(np.float64)
+    weights=np.broadcast_to(weights,data.shape)
+    valid=~np.ma.getmaskarray(values)&(weights>0)
+    weights=np.where(valid,weights,0.0)
+    total=weights.sum(axis=1)
+    empty=total==0
+    total=np.where(empty,1.0,total)
+    mean=(data*weights).sum(axis=1)/total
+    results={'mean':np.ma.masked_where(empty,mean)}
+    for name in names:
+        if name=='min':
+            result=np.where(valid,data,np.inf).min(axis=1)
+        elif name=='max':
+            result=np.where(valid,data,-np.inf).max(axis=1)
+        elif name=='std':
+            result=np.sqrt(((data-mean[:,None])**2*weights).sum(axis=1)/total)
+        else:
+            #weighted percentile: the first value (in order) at which the running
+            #weight reaches the fraction of the total - ignored points sort last,
+            #and rounding in the running total mustn't reach past the valid ones
+            order=np.argsort(np.where(valid,data,np.inf),axis=1)
+            running=np.cumsum(np.take_along_axis(weights,order,axis=1),axis=1)
+            position=(running<float(name[1:])/100.0*total[:,None]).sum(axis=1)
+            position=np.minimum(position,np.maximum(valid.sum(axis=1)-1,0))
+            result=np.take_along_axis(np.take_along_axis(data,order,axis=1),position[:,None],axis=1)[:,0]
+        results[name]=np.ma.masked_where(empty,result)
+    return(results)
+
+def statistic_field(template,name,values):
+    #copy of a collapsed field holding one of the extra statistics, with the
+    #method of its last cell method changed to match. CF has no percentile method,
+    #so other than p0, p50 and p100 a percentile drops that cell method and says
+    #what it is in a percentile property instead
+    statistic=set_collapsed_data(template.copy(),values)
+    methods={'min':'minimum','max':'maximum','std':'standard_deviation'}
+    if name.startswith('p'):
+        methods[name]={0:'minimum',50:'median',100:'maximum'}.get(float(name[1:]))
+    cell_methods=statistic.cell_methods()
+    if len(cell_methods)>0:
+        key=sorted(cell_methods)[-1]
+        if methods[name] is None:
+            statistic.del_construct(key)
+        else:
+            cell_methods[key].set_method(methods[name])
+    if methods[name] is None:
+        statistic.set_property('percentile',name[1:]+' (weighted by cell size)')
+    statistic.standard_name=template.standard_name+'_'+name
+    return(statistic)
+
+def area_statistics(field,mean):
+    #the extra statistics of the area mean of a field that didn't go through the
+    #batched path: the field is read once, with the other axes as rows
+    if len(statistics)==0:
+        return(cf.FieldList())
+    if len(field.cell_measures().filter_by_measure('area'))>0:
+        print("No statistics for "+field.identity()+" - it has its own area measure")
+        return(cf.FieldList())
+    weights=area_weights_array(field).astype(np.float64).ravel()
+    results=weighted_statistics(field_to_rows(field),weights,statistics)
+    return(cf.FieldList([statistic_field(mean,name,results[name]) for name in statistics]))
+
+def area_regions(field,mean):
+    #the means over each of atm_regions of a field that didn't go through the
+    #batched path - the same sparse product, with the other axes as rows, so the
+    #index file has the same series whether or not the means are batched
+    if len(atm_regions)==0:
+        return(cf.FieldList())
+    if len(field.cell_measures().filter_by_measure('area'))>0 or field.dimension_coordinate('X',default=None) is None or field.dimension_coordinate('Y',default=None) is None:
+        raise ValueError("Can't mean "+field.identity()+" over the regions "+', '.join(atm_regions)+" - that needs X and Y dimension coordinates and no area measure")
+    weights=area_weights_array(field).astype(np.float64).ravel()
+    latitude,longitude=grid_points(field)
+    matrix=region_matrix(grid_signature([field.coord('Y'),field.coord('X')]),atm_regions,latitude,longitude,weights)
+    means=region_means(field_to_rows(field),matrix)[0]
+    regionals=cf.FieldList()
+    for n,region in enumerate(atm_regions):
+        regionals.append(regional_mean(mean,region,means[:,n]))
+    return(regionals)
+
+def regional_mean(mean,region,values):
+    #copy of a global area mean holding its mean over one region
+    regional=set_collapsed_data(mean.copy(),values)
+    regional.standard_name=mean.standard_name+'_'+region
+    regional.set_property('region',region)
+    return(regional)
+
 def area_mean(field,job):
     x_bounds=field.coord('X').create_bounds()
     y_bounds=field.coord('Y').create_bounds()
     field.coord('X').set_bounds(x_bounds)
     field.coord('Y').set_bounds(y_bounds)
-    area=field.weights('area')
+    area=area_weights(field)
     mean=field.collapse('area: mean',weights=area,squeeze=True)
     mean.set_properties({'job': job})
     return(mean)
 
+def batchable(field):
+    #can this field go through the batched area mean?
+    #it needs to be (time,Y,X) with X and Y dimension coordinates and no area measure
+    if field.ndim!=3:
+        return(False)
+    axes=[field.domain_axis(name,key=True,default=None) for name in ('T','Y','X')]
+    if None in axes or set(axes)!=set(field.get_data_axes()):
+        return(False)
+    if field.dimension_coordinate('X',default=None) is None or field.dimension_coordinate('Y',default=None) is None:
+        return(False)
+    if len(field.cell_measures().filter_by_measure('area'))>0:
+        return(False)
+    return(True)
+
+def field_to_rows(field):
+    #data of a field as a masked (rows,Y*X) array - the axes other than Y and X,
+    #in the order of the field, make the rows
+    data_axes=field.get_data_axes()
+    horizontal_axes=[field.domain_axis(name,key=True) for name in ('Y','X')]
+    other_axes=[axis for axis in data_axes if not axis in horizontal_axes]
+    array=np.ma.transpose(np.ma.asarray(field.array),[data_axes.index(axis) for axis in other_axes+horizontal_axes])
+    return(array.reshape(-1,array.shape[-2]*array.shape[-1]))
+
+def field_to_tyx(field):
+    #data of a (time,Y,X) field as a masked float64 (time,Y*X) array
+    data_axes=field.get_data_axes()
+    order=[data_axes.index(field.domain_axis(name,key=True)) for name in ('T','Y','X')]
+    array=np.ma.transpose(np.ma.asarray(field.array),order).astype(np.float64)
+    return(array.reshape(array.shape[0],-1))
+
+def set_collapsed_data(template,values):
+    #put the values computed outside cf into the (lazy) collapsed field
+    #the metadata (coordinates, bounds, cell methods) is exactly what cf writes
+    values=np.ma.asarray(values).reshape(template.shape)
+    template.set_data(cf.Data(values,units=template.Units),axes=template.get_data_axes())
+    return(template)
+
+def area_means(fields,job):
+    #area means of a list of fields, returned in the same order
+    #(time,Y,X) fields sharing a grid are stacked into one array and reduced with
+    #one weighted matrix-vector product - cf only has to build each variable's
+    #collapsed metadata. The stack is split into batches that fit in the memory
+    #budget. Anything else goes through area_mean
+    means=[None]*len(fields)
+    extras=cf.FieldList()
+    groups={}
+    for n,field in enumerate(fields):
+        if batch_means and batchable(field):
+            x_bounds=field.coord('X').create_bounds()
+            y_bounds=field.coord('Y').create_bounds()
+            field.coord('X').set_bounds(x_bounds)
+            field.coord('Y').set_bounds(y_bounds)
+            signature=grid_signature([field.coord('Y'),field.coord('X')])
+            if not signature in groups:
+                groups[signature]=[]
+            groups[signature].append(n)
+        else:
+            with stage('reduce atm '+field.identity()):
+                means[n]=persist([area_mean(field,job)])[0]
+                extras.extend(persist(area_statistics(field,means[n])))
+                extras.extend(persist(area_regions(field,means[n])))
+
+    budget=memory_budget
+    if budget is None:
+        budget=batch_budget
+    batches=[]
+    for signature,members in groups.items():
+        #the stack, its filled copy and the mask (and weights) - ~4 float64s a point
+        batch=[]
+        batch_bytes=0
+        for n in members:
+            field_bytes=fields[n].size*4*8
+            if len(batch)>0 and batch_bytes+field_bytes>budget:
+                batches.append((signature,batch))
+                batch=[]
+                batch_bytes=0
+            batch.append(n)
+            batch_bytes+=field_bytes
+        batches.append((signature,batch))
+
+    for signature,members in batches:
+        with stage('reduce atm batch of '+str(len(members))):
+            weights=area_weights_array(fields[members[0]]).astype(np.float64).ravel()
+            print("Batched area mean of "+str(len(members))+" variables")
+            stack=np.ma.concatenate([field_to_tyx(fields[n]) for n in members])
+            #the global mean and the mean over every region in atm_regions - one
+            #sparse product for the whole batch
+            latitude,longitude=grid_points(fields[members[0]])
+            matrix=region_matrix(signature,['global']+atm_regions,latitude,longitude,weights)
+            stack_means=region_means(stack,matrix)[0]
+            stack_mean=stack_means[:,0]
+            if len(statistics)>0:
+                stack_statistics=weighted_statistics(stack,weights,statistics)
+
+            start=0
+            for n in members:
+                field=fields[n]
+                ntimes=field.shape[field.get_data_axes().index(field.domain_axis('T',key=True))]
+                mean=field.collapse('area: mean',weights=area_weights(field),squeeze=True)
+                set_collapsed_data(mean,stack_mean[start:start+ntimes])
+                mean.set_properties({'job': job})
+                means[n]=mean
+                for name in statistics:
+                    extras.append(statistic_field(mean,name,stack_statistics[name][start:start+ntimes]))
+                for n_region,region in enumerate(atm_regions):
+                    extras.append(regional_mean(mean,region,stack_means[start:start+ntimes,n_region+1]))
+                start+=ntimes
+
+    #the extra statistics follow the means
+    return(cf.FieldList(means+list(extras)))
+
+
+
+#the three realms, in the order they are written to the index file
+realms=['ocean','ice','atm']
+
+def get_realm(realm):
+    if realm=='ocean':
+        return(get_ocean(ocean_variables,ocn_patterns))
+    if realm=='ice':
+        return(get_ice(ice_patterns))
+    if realm=='atm':
+        return(get_atm(atm_variables,atm_patterns))
+
+def realm_worker(realm):
+    #runs in a forked worker process - the globals set in the main block are inherited
+    #the stage timings of the worker are sent back with its results
+    del stage_timings[:]
+    try:
+        fieldlist=get_realm(realm)
+        #compute any lazy data here, rather than in the parent at cf.write
+        persist(fieldlist)
+        return(fieldlist,None,stage_timings)
+    except:
+        #exit() in the realm functions also ends up here
+        return(None,(get_error(),error_place()),stage_timings)
+
+def checkpoint_file(realm,inputs):
+    #the checkpoint name includes a hash of the realm's inputs, so a checkpoint
+    #computed from different files or variables is never used
+    key=hashlib.sha1(json.dumps(inputs[realm],sort_keys=True).encode()).hexdigest()[:16]
+    return(os.path.join(checkpoint_dir,'index_'+job+'_'+date+'_'+realm+'_'+key+'.nc'))
+
+def read_checkpoint(realm,inputs):
+    if not checkpoint_dir:
+        return(None)
+    this_file=checkpoint_file(realm,inputs)
+    if not os.path.exists(this_file):
+        return(None)
+    try:
+        fieldlist=cf.read(this_file)
+    except Exception:
+        print("Can't read checkpoint "+this_file+" - recomputing "+realm)
+        return(None)
+    print("Resuming "+realm+" from "+this_file)
+    return(fieldlist)
+
+def write_checkpoint(realm,inputs,fieldlist):
+    if not checkpoint_dir or len(fieldlist)==0:
+        return
+    this_file=checkpoint_file(realm,inputs)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir,exist_ok=True)
+    #write to a temporary file first, so a half written checkpoint is never read
+    with stage('checkpoint '+realm):
+        cf.write(fieldlist,this_file+'.'+str(os.getpid())+'.tmp')
+        os.replace(this_file+'.'+str(os.getpid())+'.tmp',this_file)
+
+def clear_checkpoints():
+    #once the index file is written the checkpoints of this cycle aren't needed
+    if not checkpoint_dir:
+        return
+    for this_file in glob.glob(os.path.join(checkpoint_dir,'index_'+job+'_'+date+'_*.nc')):
+        os.remove(this_file)
+
+def get_realms_parallel(these_realms,inputs):
+    #ocean, ice and atmosphere read different files and share no state, so
+    #run them in a pool of processes - wall time is then roughly the slowest realm
+    print("Running "+', '.join(these_realms)+" in parallel")
+    fieldlists={}
+    errors=[]
+    places=[]
+    context=multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(these_realms),mp_context=context) as pool:
+        futures={realm:pool.submit(realm_worker,realm) for realm in these_realms}
+        for realm in these_realms:
+            fieldlist,error,worker_timings=futures[realm].result()
+            stage_timings.extend(worker_timings)
+            if error is not None:
+                errors.append(realm+': '+error[0])
+                places.append(realm+':'+error[1])
+            else:
+                fieldlists[realm]=fieldlist
+                write_checkpoint(realm,inputs,fieldlist)
+    if len(errors)>0:
+        #raise in the parent so the failure goes through report_error as before
+        error=RuntimeError("\n".join(errors))
+        error.places=places
+        raise error
+    return(fieldlists)
+
+def get_realms(these_realms,inputs):
+    #realms with a checkpoint from an earlier (failed) run of this cycle are read
+    #back; the others are computed and checkpointed as each one finishes
+    fieldlists={}
+    for realm in these_realms:
+        fieldlist=read_checkpoint(realm,inputs)
+        if fieldlist is not None:
+            fieldlists[realm]=fieldlist
+    these_realms=[realm for realm in these_realms if not realm in fieldlists]
+    if parallel_realms and len(these_realms)>1:
+        fieldlists.update(get_realms_parallel(these_realms,inputs))
+        return(fieldlists)
+    for realm in these_realms:
+        fieldlists[realm]=get_realm(realm)
+        write_checkpoint(realm,inputs,fieldlists[realm])
+    return(fieldlists)
+
+def realm_inputs(realm):
+    #input files (with size and mtime) of a realm - only the inventory is used,
+    #nothing is read
+    if realm=='ocean':
+        for grid in ocean_variables:
+            ocean_files(grid,ocn_patterns)
+    if realm=='ice':
+        cice_files(ice_patterns)
+    if realm=='atm':
+        monthly_atm_files(atm_patterns)
+        stream_files(fallback_streams)
+    files=realm_inventory(realm)
+    return({path:[files[path]['size'],files[path]['mtime']] for path in sorted(files)})
+
+def build_manifest():
+    #what each realm's indices were computed from
+    manifest={'inputs':{},'fields':{}}
+    for realm in realms:
+        manifest['inputs'][realm]={'files':realm_inputs(realm),
+                                   'variables':realm_variables[realm],
+                                   'statistics':statistics}
+    return(manifest)
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return(None)
+    try:
+        with open(manifest_file) as f:
+            return(json.load(f))
+    except (OSError,ValueError):
+        print("Can't read "+manifest_file+" - ignoring it")
+        return(None)
+
+def write_manifest(manifest_file,manifest):
+    tmp_file=manifest_file+'.tmp'
+    with open(tmp_file,'w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(tmp_file,manifest_file)
+
+def changed_realms(manifest,previous):
+    #compare the inputs of each realm against the manifest of the previous run
+    if previous is None or not os.path.exists(outfile):
+        return(list(realms))
+    changed=[]
+    for realm in realms:
+        if previous.get('inputs',{}).get(realm)!=manifest['inputs'][realm]:
+            changed.append(realm)
+        elif not realm in previous.get('fields',{}):
+            changed.append(realm)
+    return(changed)
+
+def previous_realm_fields(previous,realm):
+    #the indices of an unchanged realm, taken from the existing index file
+    names=previous['fields'][realm]
+    fieldlist=cf.FieldList()
+    for field in cf.read(outfile):
+        if field.get_property('standard_name',None) in names:
+            fieldlist.append(field)
+    return(fieldlist)
+
+
+def store_name(field):
+    #netCDF variable name of an index in the store
+    name=field.get_property('standard_name',None)
+    if name is None:
+        name=field.nc_get_variable(field.identity())
+    return(re.sub('[^A-Za-z0-9_]','_',name))
+
+def store_slots(nc,months,time_values):
+    #slot for each month - rerunning a cycle reuses its slots, new months are
+    #appended (so after a backfill the slots are not necessarily in time order)
+    stored=list(nc.variables['yyyymm'][:])
+    slots=[]
+    for month,time_value in zip(months,time_values):
+        if month in stored:
+            slots.append(stored.index(month))
+        else:
+            slot=len(stored)
+            nc.variables['yyyymm'][slot]=month
+            nc.variables['time'][slot]=time_value
+            stored.append(month)
+            slots.append(slot)
+    return(slots)
+
+def append_to_store(fieldlist):
+    #write the indices of this cycle into the per-job store, one variable per index
+    #with an unlimited time dimension - a slot is identified by its year and month
+    store_file=out_dir+'/timeseries_'+job+'.nc'
+    #other cycles of the same job may be running at the same time
+    with open(store_file+'.lock','w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        if os.path.exists(store_file):
+            nc=netCDF4.Dataset(store_file,'a')
+        else:
+            nc=netCDF4.Dataset(store_file+'.tmp','w')
+        try:
+            for field in fieldlist:
+                time_key=field.coord('time',key=True,default=None)
+                if time_key is None:
+                    print("No time coordinate for "+field.identity()+" - not added to "+store_file)
+                    continue
+                time=field.coord('time')
+                if not 'time' in nc.dimensions:
+                    nc.setncattr('job',job)
+                    nc.createDimension('time',None)
+                    time_var=nc.createVariable('time','f8',('time',))
+                    time_var.standard_name='time'
+                    time_var.units=str(time.Units.units)
+                    time_var.calendar=time.Units.calendar or 'standard'
+                    month_var=nc.createVariable('yyyymm','i4',('time',))
+                    month_var.long_name='year and month of the slot'
+
+                #put the times in the units of the store
+                time_var=nc.variables['time']
+                time_values=time.copy()
+                time_values.Units=cf.Units(time_var.units,calendar=time_var.calendar)
+                months=list(time.year.array.ravel()*100+time.month.array.ravel())
+                slots=store_slots(nc,months,time_values.array.ravel())
+
+                #time first, everything else flattened into one dimension
+                data=np.ma.asarray(field.array)
+                time_axis=field.get_data_axes(time_key)[0]
+                if time_axis in field.get_data_axes():
+                    data=np.ma.moveaxis(data,field.get_data_axes().index(time_axis),0)
+                data=data.reshape(len(months),-1)
+
+                name=store_name(field)
+                if not name in nc.variables:
+                    dimensions=('time',)
+                    if data.shape[1]>1:
+                        nc.createDimension(name+'_n',data.shape[1])
+                        dimensions=('time',name+'_n')
+                    var=nc.createVariable(name,'f8',dimensions,fill_value=1.0e20)
+                    var.units=str(field.Units.units or '1')
+                    if field.has_property('long_name'):
+                        var.long_name=field.get_property('long_name')
+                var=nc.variables[name]
+                for n,slot in enumerate(slots):
+                    if var.ndim==1:
+                        var[slot]=data[n,0]
+                    else:
+                        var[slot,:]=data[n,:]
+        finally:
+            nc.close()
+        if os.path.exists(store_file+'.tmp'):
+            os.replace(store_file+'.tmp',store_file)
+    print("Added to "+store_file)
+
+def process_cycle(this_date):
+    #compute and write the index file for one cycle of the current job
+    global date,data_dir,inventory,outfile,manifest_file
+    date=this_date
+    data_dir=transfer_dir+'/'+date
 
+    outfile=out_dir+'/index_'+job+'_'+date+'.nc'
+    #sidecar recording the inputs the index file was computed from
+    manifest_file=out_dir+'/index_'+job+'_'+date+'.manifest.json'
+    #sidecar with the cost of each stage
+    timing_file=out_dir+'/index_'+job+'_'+date+'.timing.json'
+
+    del stage_timings[:]
+    #a skipped cycle keeps the report of the run that wrote its index file
+    computed=True
+    try:
+        with stage('discovery'):
+            #one scan of the cycle directory shared by all the readers
+            inventory=build_inventory(data_dir)
+        computed=calculate_cycle()
+    finally:
+        if timing and computed:
+            write_timings(timing_file)
+
+def calculate_cycle():
+    print('Opening job '+job+' date: '+date)
 
-
-try:
-    #sent from PUMA/CYLC 
-    cylc_version=os.getenv('CYLC_VERSION')
-    if cylc_version==None:
-        print("CYLC_VERSION env variable not defined!")
-        exit()
-    if int(cylc_version.split('.')[0])<8:
-        cylc_name=os.getenv('CYLC_SUITE_NAME')
+    manifest=build_manifest()
+    previous=read_manifest(manifest_file)
+    if incremental:
+        compute_realms=changed_realms(manifest,previous)
     else:
-        cylc_name=os.getenv('CYLC_WORKFLOW_NAME')
+        compute_realms=list(realms)
 
+    if len(compute_realms)==0:
+        print("Inputs unchanged since "+outfile+" was written - nothing to do")
+        return(False)
+
+    if len(compute_realms)<len(realms):
+        print("Recomputing "+', '.join(compute_realms)+" only")
+
+    #Ocean, Ice and Atm
+    outlist=cf.FieldList()
+    fieldlists=get_realms(compute_realms,manifest['inputs'])
+    for realm in realms:
+        if realm in compute_realms:
+            outlist.extend(fieldlists[realm])
+            manifest['fields'][realm]=[field.get_property('standard_name',None) for field in fieldlists[realm]]
+        else:
+            outlist.extend(previous_realm_fields(previous,realm))
+            manifest['fields'][realm]=previous['fields'][realm]
 
+    print("Writing "+outfile)
+    #write to a temporary file first - the existing index may still be being read from
+    with stage('write'):
+        cf.write(outlist,outfile+'.tmp')
+        os.replace(outfile+'.tmp',outfile)
+    write_manifest(manifest_file,manifest)
+    clear_checkpoints()
+    if timeseries_store:
+        with stage('store'):
+            append_to_store(outlist)
+    print("Done ")
+    return(True)
+
+def select_suite(suite_name):
+    #point the job globals at one suite - in ensemble mode each member is
+    #selected in turn, and the grid weights, cell measures and AMOC rows cached
+    #by the first member are reused by the rest
+    global cylc_name,transfer_dir,job
+    cylc_name=suite_name
     #Transfer dir on JASMIN
     transfer_dir=os.environ['TRANSFER_DIR']+'/'+cylc_name
 
     #get runid from cylc_suite_name
     job=cylc_name.split('-')[-1]
 
-    #cylc_task_cycle_time
-    date=os.environ['CYLC_TASK_CYCLE_POINT']
+def backfill_dates(first_date,last_date):
+    #all the cycle directories of this job between first_date and last_date (inclusive)
+    #cycle points are ISO 8601 so they sort as strings
+    dates=[]
+    for entry in sorted(os.listdir(transfer_dir)):
+        if first_date<=entry<=last_date and os.path.isdir(transfer_dir+'/'+entry):
+            dates.append(entry)
+    return(dates)
+
+def cycle_signature(directory):
+    #names, sizes and mtimes of the files in a cycle directory, and the newest mtime
+    files=[]
+    newest=0.0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat=entry.stat()
+            files.append((entry.name,stat.st_size,stat.st_mtime))
+            newest=max(newest,stat.st_mtime)
+    return(tuple(sorted(files)),newest)
+
+def watch_cycles(poll,settle):
+    #poll transfer_dir for cycle directories and process each one, in this process,
+    #once its files have stopped changing: the same for two polls in a row and none
+    #modified in the last settle seconds. A cycle is processed again if its files change.
+    #cycles that already have an index file when we start are only processed if they change
+    print("Watching "+transfer_dir+" every "+format(poll,'g')+"s")
+    last_poll={}
+    done={}
+    for entry in sorted(os.listdir(transfer_dir)):
+        if os.path.isdir(transfer_dir+'/'+entry) and os.path.exists(out_dir+'/index_'+job+'_'+entry+'.nc'):
+            done[entry]=cycle_signature(transfer_dir+'/'+entry)[0]
+    while True:
+        for entry in sorted(os.listdir(transfer_dir)):
+            if not os.path.isdir(transfer_dir+'/'+entry):
+                continue
+            try:
+                files,newest=cycle_signature(transfer_dir+'/'+entry)
+            except OSError:
+                #the directory went away while we were looking
+                continue
+            previous=last_poll.get(entry)
+            last_poll[entry]=files
+            if len(files)==0 or files!=previous or done.get(entry)==files:
+                continue
+            if time.time()-newest<settle:
+                continue
+            try:
+                process_cycle(entry)
+            except KeyboardInterrupt:
+                raise
+            except:
+                print("An error happened!")
+                report_error()
+            #a failed cycle isn't retried until its files change
+            done[entry]=files
+        time.sleep(poll)
+
+
+parser=argparse.ArgumentParser(description='Compute global mean indices for job monitoring')
+parser.add_argument('--parallel-realms',action='store_true',
+                    help='compute the ocean, ice and atmosphere indices in parallel processes (or set MONITOR_PARALLEL_REALMS=1)')
+parser.add_argument('--suite',nargs='+',
+                    help='suite/workflow name(s), instead of taking it from the CYLC environment - several names are processed as an ensemble in one process, writing one index file per job')
+parser.add_argument('--date',
+                    help='cycle point to process, instead of CYLC_TASK_CYCLE_POINT')
+parser.add_argument('--backfill',nargs=2,metavar=('FIRST_DATE','LAST_DATE'),
+                    help='process every cycle from FIRST_DATE to LAST_DATE in this one process')
+parser.add_argument('--watch',action='store_true',
+                    help='keep running, processing each new cycle directory in TRANSFER_DIR/<suite> once its files stop changing')
+parser.add_argument('--poll',type=float,default=float(os.getenv('MONITOR_WATCH_POLL','300')),
+                    help='seconds between looks at TRANSFER_DIR/<suite> in --watch mode (default 300, or MONITOR_WATCH_POLL)')
+parser.add_argument('--settle',type=float,default=float(os.getenv('MONITOR_WATCH_SETTLE','600')),
+                    help='seconds since the last file change before a cycle is processed in --watch mode (default 600, or MONITOR_WATCH_SETTLE)')
+args=parser.parse_args()
+if args.watch and args.suite is not None and len(args.suite)>1:
+    parser.error("--watch follows one suite")
+
+parallel_realms=args.parallel_realms or os.getenv('MONITOR_PARALLEL_REALMS','0')=='1'
+
+#only recompute realms whose input files (or variables) have changed since the
+#index file was written - set MONITOR_INCREMENTAL=0 to always recompute
+incremental=os.getenv('MONITOR_INCREMENTAL','1')!='0'
+
+failed_dates=[]
+#used by get_error, so define them before anything can go wrong
+job=''
+date=''
+data_dir=''
+transfer_dir=''
+try:
+    if args.suite is not None:
+        cylc_names=args.suite
+    else:
+        #sent from PUMA/CYLC 
+        cylc_version=os.getenv('CYLC_VERSION')
+        if cylc_version==None:
+            print("CYLC_VERSION env variable not defined!")
+            exit()
+        if int(cylc_version.split('.')[0])<8:
+            cylc_names=[os.getenv('CYLC_SUITE_NAME')]
+        else:
+            cylc_names=[os.getenv('CYLC_WORKFLOW_NAME')]
+
+    select_suite(cylc_names[0])
 
     #Directory to write the index file to
     #out_dir=os.environ['INDEX_DIR']
@@ -712,8 +2401,6 @@ try:
         os.makedirs(out_dir)
         print(f"Created output directory: {out_dir}")
 
-    data_dir=transfer_dir+'/'+date
-
     atm_patterns=os.environ['ATM_PATTERNS']
     ice_patterns=os.environ['ICE_PATTERNS']
     ocn_patterns=os.environ['OCN_PATTERNS']
@@ -721,36 +2408,71 @@ try:
     ocn_t_grid=os.environ['OCN_T_GRID']
     ocn_diaptr=os.environ['OCN_DIAPTR']
 
-    
-    #no MSLP in 1m? 16222
 
-    outlist=cf.FieldList()
-    atm_variables=[1201,1207,1208,1209,1210,1211,1235,2201,2204,2205,2206,2207,2208,3217,3223,3225,3226,3232,3234,3236,3237,3245,3317,4204,5205,5206,5215,5216,23,24,409,8023,8208,8209,8223,8225,8234,4203,16222]
+    registry_variables,atm_indices,region_library=read_index_registry(index_registry_file)
+    atm_variables=registry_variables['atm']
+    atm_regions=registry_variables['regions']
+    seaice_regions=registry_variables['seaice_regions']
     #ocean_variables={'grid_T':['sea_water_potential_temperature','sea_water_salinity'],'diaptr':['meridional_streamfunction_atlantic']}
 
-    ocean_variables={ocn_t_grid:['sea_water_potential_temperature','sea_water_salinity'],ocn_diaptr:['meridional_streamfunction_atlantic']}
-
-    outfile=out_dir+'/index_'+job+'_'+date+'.nc'
-
-    print('Opening job '+job+' date: '+date)
-
-
-    #Ocean
-    outlist.extend(get_ocean(ocean_variables,ocn_patterns))
-    #Ice
-    outlist.extend(get_ice(ice_patterns))
-    #Atm
-    outlist.extend(get_atm(atm_variables,atm_patterns))
-    
-
-    print("Writing "+outfile)
-    cf.write(outlist,outfile)
-    print("Done ")
-
+    ocean_variables={ocn_t_grid:registry_variables['ocean'],ocn_diaptr:['meridional_streamfunction_atlantic']}
+
+    #region definitions are included, so editing a region recomputes the realms using it
+    #the AMOC latitude is included, so changing AMOC_LATITUDE recomputes the ocean realm
+    realm_variables={'ocean':{'variables':ocean_variables,'amoc_latitude':amoc_latitude},
+                     'ice':{'variables':['aice'],'regions':{name:region_library[name] for name in ['northern_hemisphere','southern_hemisphere']+seaice_regions},
+                            #lists, not tuples, so they compare equal to the copy in the manifest
+                            'bands':[list(band) for band in seaice_bands]},
+                     'atm':{'variables':atm_variables,'indices':atm_indices,'regions':atm_regions,
+                            'region_definitions':{name:region_library[name] for name in region_library if name in atm_regions or any(name in (index['region'],index['minus_region']) for index in atm_indices)}}}
+
+    if args.backfill is not None:
+        #grid weights and cell measures are cached, so are only computed for the first cycle
+        for cylc_name in cylc_names:
+            select_suite(cylc_name)
+            dates=backfill_dates(args.backfill[0],args.backfill[1])
+            print("Backfilling "+str(len(dates))+" cycles of "+job)
+            for this_date in dates:
+                try:
+                    process_cycle(this_date)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    print("An error happened!")
+                    report_error()
+                    failed_dates.append(job+' '+this_date)
+    elif args.watch:
+        #caches (weights, grid measures, AMOC rows) stay warm from one cycle to the next
+        watch_cycles(args.poll,args.settle)
+    else:
+        #cylc_task_cycle_time
+        this_date=args.date
+        if this_date is None:
+            this_date=os.environ['CYLC_TASK_CYCLE_POINT']
+        if len(cylc_names)==1:
+            process_cycle(this_date)
+        else:
+            #ensemble - a failed member doesn't stop the others
+            print("Ensemble of "+str(len(cylc_names))+" jobs for "+this_date)
+            for cylc_name in cylc_names:
+                select_suite(cylc_name)
+                try:
+                    process_cycle(this_date)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    print("An error happened!")
+                    report_error()
+                    failed_dates.append(job+' '+this_date)
+
+except KeyboardInterrupt:
+    #the way out of --watch
+    print("Stopped")
 except:
     print("An error happened!")
     report_error()
     exit(99)
 
-
-
+if len(failed_dates)>0:
+    print("Failed cycles: "+' '.join(failed_dates))
+    exit(99)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+#D: Header level integrity checks for the netCDF files read by the monitor scripts
+#
+#A truncated or half written netCDF file is found from its header alone - no
+#data is decoded:
+# classic (CDF-1, CDF-2, CDF-5) files: the header is parsed and the end of the
+#  last variable (and of the last record) is compared to the file size
+# netCDF4 (HDF5) files: the end of file address in the superblock is compared to
+#  the file size
+#
+#Verdicts are kept in a hidden .netcdf_verdicts.json in each directory, keyed by
+#file name, size and mtime, so a file is only checked again if it changes
+#
+#map_files runs a reader over a list of files on a pool of threads or processes
+
+import os
+import json
+import multiprocessing
+import concurrent.futures
+
+verdict_file_name='.netcdf_verdicts.json'
+
+#files read at once by map_files - 1 reads them one after the other
+read_workers=int(os.getenv('MONITOR_READ_WORKERS','1'))
+#process or thread - the netCDF-C/HDF5 libraries under cf.read are not thread
+#safe, so only use threads with a reader that takes its own lock. Processes also
+#spread the header decoding over several cores, but the results are pickled back
+read_pool=os.getenv('MONITOR_READ_POOL','process')
+if not read_pool in ('thread','process'):
+    raise ValueError("MONITOR_READ_POOL must be thread or process, not "+read_pool)
+
+hdf5_signature=b'\x89HDF\r\n\x1a\n'
+
+#bytes per value of each classic nc_type (7-11 are CDF-5 only)
+classic_type_sizes={1:1,2:1,3:2,4:4,5:4,6:8,7:1,8:2,9:4,10:8,11:8}
+
+#numrecs of a classic file that is still being written (or was never closed)
+streaming_numrecs={1:0xFFFFFFFF,2:0xFFFFFFFF,5:0xFFFFFFFFFFFFFFFF}
+
+
+class TruncatedHeader(Exception):
+    pass
+
+def read_exactly(f,size):
+    data=f.read(size)
+    if len(data)!=size:
+        raise TruncatedHeader()
+    return(data)
+
+def read_int(f,size):
+    #classic files are big-endian
+    return(int.from_bytes(read_exactly(f,size),'big'))
+
+def padded(size):
+    return((size+3)//4*4)
+
+def skip_name(f,count_size):
+    read_exactly(f,padded(read_int(f,count_size)))
+
+def skip_attributes(f,count_size):
+    #tag (NC_ATTRIBUTE=12, or 0 for none) and number of attributes
+    read_int(f,4)
+    for n in range(read_int(f,count_size)):
+        skip_name(f,count_size)
+        nc_type=read_int(f,4)
+        if not nc_type in classic_type_sizes:
+            raise ValueError("unknown attribute type "+str(nc_type))
+        read_exactly(f,padded(read_int(f,count_size)*classic_type_sizes[nc_type]))
+
+def classic_problem(f,version,file_size):
+    #why the classic netCDF file open as f is truncated, or None if it isn't
+    #CDF-1 has 4 byte counts and offsets, CDF-2 8 byte offsets, CDF-5 8 byte both
+    count_size=8 if version==5 else 4
+    offset_size=4 if version==1 else 8
+    try:
+        numrecs=read_int(f,count_size)
+
+        #dimensions - a length of 0 is the record dimension
+        read_int(f,4)
+        dimensions=[]
+        for n in range(read_int(f,count_size)):
+            skip_name(f,count_size)
+            dimensions.append(read_int(f,count_size))
+
+        skip_attributes(f,count_size)
+
+        variables=[]
+        read_int(f,4)
+        for n in range(read_int(f,count_size)):
+            skip_name(f,count_size)
+            dimids=[read_int(f,count_size) for m in range(read_int(f,count_size))]
+            skip_attributes(f,count_size)
+            nc_type=read_int(f,4)
+            if not nc_type in classic_type_sizes:
+                raise ValueError("unknown variable type "+str(nc_type))
+            #vsize in the header overflows for large variables, so work it out
+            read_int(f,count_size)
+            begin=read_int(f,offset_size)
+            is_record=len(dimids)>0 and dimensions[dimids[0]]==0
+            size=classic_type_sizes[nc_type]
+            for dimid in dimids[1 if is_record else 0:]:
+                size*=dimensions[dimid]
+            variables.append((begin,size,is_record))
+    except TruncatedHeader:
+        return("header is truncated")
+    except (ValueError,IndexError) as error:
+        return("header is corrupt: "+str(error))
+
+    header_end=f.tell()
+    if numrecs==streaming_numrecs[version]:
+        return("number of records was never written - the file was not closed")
+
+    #a record is one (padded) slab of each record variable - unless there is only
+    #one record variable, when the slabs are not padded
+    record_variables=[variable for variable in variables if variable[2]]
+    if len(record_variables)==1:
+        record_size=record_variables[0][1]
+    else:
+        record_size=sum(padded(variable[1]) for variable in record_variables)
+
+    #the last variable need not be padded to 4 bytes
+    expected=header_end
+    for begin,size,is_record in variables:
+        if is_record:
+            if numrecs>0:
+                expected=max(expected,begin+(numrecs-1)*record_size+size)
+        else:
+            expected=max(expected,begin+size)
+    if file_size<expected:
+        return("truncated - "+str(file_size)+" bytes, the header describes "+str(expected))
+    return(None)
+
+def hdf5_problem(f,file_size):
+    #why the HDF5 (netCDF4) file open as f is truncated, or None if it isn't
+    #the superblock is at 0, 512, 1024, 2048 ... bytes
+    base=0
+    while True:
+        if base+len(hdf5_signature)>file_size:
+            return("no HDF5 superblock")
+        f.seek(base)
+        if f.read(len(hdf5_signature))==hdf5_signature:
+            break
+        base=512 if base==0 else base*2
+
+    try:
+        version=read_int(f,1)
+        if version in (0,1):
+            #free-space, root group and shared header versions, reserved
+            read_exactly(f,4)
+            offset_size=read_int(f,1)
+            #length size, reserved, group K values, consistency flags
+            read_exactly(f,1+1+2+2+4)
+            if version==1:
+                #indexed storage K, reserved
+                read_exactly(f,4)
+            base_address=int.from_bytes(read_exactly(f,offset_size),'little')
+            #free-space info address
+            read_exactly(f,offset_size)
+            eof_address=int.from_bytes(read_exactly(f,offset_size),'little')
+        elif version in (2,3):
+            offset_size=read_int(f,1)
+            read_int(f,1)
+            flags=read_int(f,1)
+            if version==3 and flags&0x1:
+                return("the file is still open for writing")
+            base_address=int.from_bytes(read_exactly(f,offset_size),'little')
+            #superblock extension address
+            read_exactly(f,offset_size)
+            eof_address=int.from_bytes(read_exactly(f,offset_size),'little')
+        else:
+            return("unknown HDF5 superblock version "+str(version))
+    except TruncatedHeader:
+        return("HDF5 superblock is truncated")
+
+    expected=base_address+eof_address
+    if file_size<expected:
+        return("truncated - "+str(file_size)+" bytes, the superblock says "+str(expected))
+    return(None)
+
+def netcdf_problem(path):
+    #why the netCDF file at path can't be read, or None if the header and the
+    #file size agree - only the header is read
+    try:
+        file_size=os.path.getsize(path)
+        with open(path,'rb') as f:
+            magic=f.read(4)
+            if magic[:3]==b'CDF' and len(magic)==4 and magic[3] in (1,2,5):
+                return(classic_problem(f,magic[3],file_size))
+            return(hdf5_problem(f,file_size))
+    except OSError as error:
+        return("can't open: "+str(error))
+
+def read_verdicts(directory):
+    try:
+        with open(os.path.join(directory,verdict_file_name)) as f:
+            return(json.load(f))
+    except (OSError,ValueError):
+        return({})
+
+def write_verdicts(directory,verdicts):
+    #write to a temporary file first - other scripts may be reading the verdicts
+    verdict_file=os.path.join(directory,verdict_file_name)
+    tmp_file=verdict_file+'.'+str(os.getpid())+'.tmp'
+    try:
+        with open(tmp_file,'w') as f:
+            json.dump(verdicts,f)
+        os.replace(tmp_file,verdict_file)
+    except OSError:
+        #a read only directory - the files are checked again next time
+        pass
+
+def valid_netcdf_files(files):
+    #the files (in the same order) whose headers agree with their size
+    #a file is only checked again if its size or mtime has changed
+    good_files=[]
+    verdicts={}
+    changed=set()
+    for file in files:
+        directory,name=os.path.split(os.path.abspath(file))
+        if not directory in verdicts:
+            verdicts[directory]=read_verdicts(directory)
+        try:
+            stat=os.stat(file)
+        except OSError as error:
+            print("couldn't read "+file+" .. skipping ("+str(error)+")")
+            continue
+        verdict=verdicts[directory].get(name)
+        if verdict is None or verdict[:2]!=[stat.st_size,stat.st_mtime]:
+            verdict=[stat.st_size,stat.st_mtime,netcdf_problem(file)]
+            verdicts[directory][name]=verdict
+            changed.add(directory)
+        if verdict[2] is None:
+            good_files.append(file)
+        else:
+            print("couldn't read "+file+" .. skipping ("+verdict[2]+")")
+    for directory in changed:
+        write_verdicts(directory,verdicts[directory])
+    return(good_files)
+
+def map_files(function,files):
+    #function(file) for each file, returned in the same order as files
+    if read_workers<=1 or len(files)<=1:
+        return([function(file) for file in files])
+    workers=min(read_workers,len(files))
+    if read_pool=='process':
+        #fork, so function can be defined in the calling script
+        executor=concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor=concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with executor as pool:
+        return(list(pool.map(function,files)))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+#D: Local stand-in for the Slack webhook, for testing the error notifications
+#
+#./monitor_webhook_standin.py [--port 8765] [--delay SECONDS] [--status CODE]
+#then run monitor_calculate_means_v7.py with
+#MONITOR_WEBHOOK_URL=http://localhost:8765/
+#
+#Each message posted is printed. --delay makes every reply slow (to check the
+#script still exits within MONITOR_NOTIFY_TIMEOUT and spools the message) and
+#--status makes every reply fail (to check the message is spooled)
+
+import argparse
+import json
+import time
+import http.server
+
+
+parser=argparse.ArgumentParser(description='Local stand-in for the Slack webhook used by monitor_calculate_means_v7.py')
+parser.add_argument('--port',type=int,default=8765,
+                    help='port to listen on (default 8765)')
+parser.add_argument('--delay',type=float,default=0.0,
+                    help='seconds to wait before replying')
+parser.add_argument('--status',type=int,default=200,
+                    help='HTTP status to reply with (default 200)')
+args=parser.parse_args()
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body=self.rfile.read(int(self.headers.get('Content-Length',0)))
+        try:
+            text=json.loads(body)['text']
+        except (ValueError,KeyError):
+            text=body.decode(errors='replace')
+        print("---- "+time.strftime('%H:%M:%S')+" message ----")
+        print(text,flush=True)
+        time.sleep(args.delay)
+        self.send_response(args.status)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+
+print("Listening on http://localhost:"+str(args.port)+"/",flush=True)
+server=http.server.ThreadingHTTPServer(('localhost',args.port),WebhookHandler)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
@@ -10,6 +10,7 @@ import cfplot_fix as cfp
 import sys
 import os 
 import glob
+import monitor_io
 from datetime import datetime
 import configparser
 import pickle
@@ -85,36 +86,37 @@ def parse_string_to_nested_dict(s1):
     return nested_dict
 
 
+def read_file(file):
+    # an empty FieldList if the file can't be read
+    try:
+        return(cf.read(file,aggregate=False))
+    except Exception as error:
+        print("couldn't read "+file+" .. skipping", type(error).__name__)
+        return(cf.FieldList())
+
 def read_safely(file_string):
-    #another idea
-    # read each file - trap any read errors
-    files=glob.glob(file_string)
+    # skip truncated or half written files, found from their headers
+    files=clean_netcdf_files(file_string)
     data=cf.FieldList()
-    for file in files:
+    if monitor_io.read_workers>1:
+        # read the files concurrently (MONITOR_READ_WORKERS) and aggregate once
+        for fieldlist in monitor_io.map_files(read_file,files):
+            data.extend(fieldlist)
+    else:
         try:
-            data.append(cf.read(file))
+            data=cf.read(files)
         except Exception as error:
-            print("couldn't read "+file+" .. skipping", type(error).__name__)
+            #a file that passed the header check but still can't be read
+            #read each file - trap any read errors
+            print("couldn't read all the files .. reading one at a time", type(error).__name__)
+            for file in files:
+                data.extend(read_file(file))
     return(cf.aggregate(data,relaxed_identities=True))
     
 def clean_netcdf_files(file_string):
-    #removes truncated netcdf files by only keeping netcdf files with the max
-    #length in the list - hopefully this should work - unless some bug causes
-    #sporadic long files!
-    files=glob.glob(file_string)
-    clean_files=[]
-    file_length=[]
-    for file in files:
-        #print(file)
-        file_length.append(os.path.getsize(file))
-    max_length=max(file_length)
-    l_count=0
-    for length in file_length:
-        #try to captures small variations, but exclude truncated files!
-        if length > 0.95*max_length:
-            clean_files.append(files[l_count])
-        l_count+=1
-    return(clean_files)
+    #removes truncated netcdf files - each header is checked against the file
+    #size (and the verdict cached), rather than guessing from the largest file
+    return(monitor_io.valid_netcdf_files(sorted(glob.glob(file_string))))
 
     
 
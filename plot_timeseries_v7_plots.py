@@ -10,6 +10,7 @@ import cfplot_fix as cfp
 import sys
 import os 
 import glob
+import monitor_io
 from datetime import datetime
 import pickle
 
@@ -74,24 +75,9 @@ def update_webpage(this_job,webroot):
 
 
 def clean_netcdf_files(file_string):
-    #removes truncated netcdf files by only keeping netcdf files with the max
-    #length in the list - hopefully this should work - unless some bug causes
-    #sporadic long files!
-    files=glob.glob(file_string)
-    clean_files=[]
-    file_length=[]
-    for file in files:
-        #print(file)
-        file_length.append(os.path.getsize(file))
-    max_length=max(file_length)
-    l_count=0
-    for length in file_length:
-        #if length == max_length:
-        #try to captures small variations, but exclude truncated files!
-        if length > 0.95*max_length:
-            clean_files.append(files[l_count])
-        l_count+=1
-    return(clean_files)
+    #removes truncated netcdf files - each header is checked against the file
+    #size (and the verdict cached), rather than guessing from the largest file
+    return(monitor_io.valid_netcdf_files(sorted(glob.glob(file_string))))
 
     
 def save_plot(canari,fields,filename,this_job):